@@ -0,0 +1,154 @@
+"""asyncio support for pyflex. Needs Python 3, so pyflex only imports it
+when StateMachine.scan_async is called."""
+import asyncio
+import time
+
+# bytes read from the StreamReader at a time
+read_size = 1 << 16
+# full reads are gathered into chunks of up to this many bytes, and
+# chunks this big are scanned in an executor
+executor_threshold = 1 << 20
+# the executor feeds big chunks in slices this big, so the GIL is passed
+# back to the event loop between slices
+slice_size = 1 << 16
+# tokens yielded between giving control back to the event loop
+yield_every = 1024
+
+def feed_slices(stream, data):
+    data = memoryview(data)
+    tokens = []
+    for i in range(0, len(data), slice_size):
+        tokens.extend(stream.feed(data[i:i + slice_size]))
+    return tokens
+
+async def read_chunk(reader):
+    """Reads up to executor_threshold bytes. Reads are gathered while they
+    come back full, as they do while data arrives faster than it is
+    scanned. A short read means the reader has caught up, so what has
+    been read is returned without waiting for more."""
+    chunks = []
+    size = 0
+    while size < executor_threshold:
+        chunk = await reader.read(read_size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size += len(chunk)
+        if len(chunk) < read_size:
+            break
+    return b''.join(chunks)
+
+async def scan_async(sm, reader, executor=None):
+    """Async iterator over the tokens read from an asyncio.StreamReader.
+
+    Chunks of executor_threshold bytes, which read_chunk gathers while
+    data comes in faster than it is scanned, are scanned in executor (the
+    loop's default one if None). Control goes back to the event loop
+    every yield_every tokens so other tasks aren't starved."""
+    stream = sm.stream()
+    loop = asyncio.get_running_loop()
+    n = 0
+    while True:
+        chunk = await read_chunk(reader)
+        if not chunk:
+            break
+        if len(chunk) >= executor_threshold:
+            tokens = await loop.run_in_executor(executor, feed_slices, stream, chunk)
+        else:
+            tokens = stream.feed(chunk)
+        for token in tokens:
+            yield token
+            n += 1
+            if n % yield_every == 0:
+                await asyncio.sleep(0)
+    for token in stream.close():
+        yield token
+
+async def serve(data, host='127.0.0.1'):
+    "a local server that sends data to every client and hangs up"
+    async def handle(reader, writer):
+        writer.write(data)
+        await writer.drain()
+        writer.close()
+    return await asyncio.start_server(handle, host, 0)
+
+async def ticker(gaps, interval=0.001):
+    "records how late the event loop wakes a 1ms sleep"
+    while True:
+        start = time.time()
+        await asyncio.sleep(interval)
+        gaps.append(time.time() - start - interval)
+
+async def bench_client(sm, port, host='127.0.0.1'):
+    reader, writer = await asyncio.open_connection(host, port)
+    n = 0
+    async for token in sm.scan_async(reader):
+        n += 1
+    writer.close()
+    return n
+
+def bench(sm, data):
+    "returns (seconds, tokens, worst event loop delay) for scanning data over a socket"
+    async def run():
+        server = await serve(data)
+        port = server.sockets[0].getsockname()[1]
+        gaps = []
+        tick = asyncio.ensure_future(ticker(gaps))
+        start = time.time()
+        n = await bench_client(sm, port)
+        seconds = time.time() - start
+        tick.cancel()
+        server.close()
+        await server.wait_closed()
+        return seconds, n, max(gaps or [0])
+    return asyncio.new_event_loop().run_until_complete(run())
+
+def test():
+    from concurrent.futures import ThreadPoolExecutor
+    import pyflex
+
+    class CountingExecutor(ThreadPoolExecutor):
+        calls = 0
+
+        def submit(self, *args, **kwargs):
+            self.calls += 1
+            return ThreadPoolExecutor.submit(self, *args, **kwargs)
+
+    sm = pyflex.compile([('word', '[a-z]+', True), ('space', '[ \\n]+', True)])
+    # one chunk of executor_threshold bytes, then a short tail
+    data = b'lorem ipsum dolor\n' * (executor_threshold // 16)
+
+    async def run(executor, data, piece_size=None):
+        reader = asyncio.StreamReader()
+        if piece_size is None:
+            reader.feed_data(data)
+            reader.feed_eof()
+        else:
+            async def trickle():
+                for i in range(0, len(data), piece_size):
+                    reader.feed_data(data[i:i + piece_size])
+                    await asyncio.sleep(0)
+                reader.feed_eof()
+            asyncio.ensure_future(trickle())
+        return [token async for token in sm.scan_async(reader, executor)]
+
+    with CountingExecutor(1) as executor:
+        tokens = asyncio.run(run(executor, data))
+    assert executor.calls == 1, executor.calls
+    assert tokens == list(sm.scan_string(data))
+
+    # a token of a few MB arriving read_size bytes at a time is scanned in
+    # about the time scan_string takes, not rescanned on every read
+    data = b'x' * (4 << 20) + b'\n'
+    start = time.time()
+    expected = list(sm.scan_string(data))
+    scan_seconds = time.time() - start
+    with ThreadPoolExecutor(1) as executor:
+        start = time.time()
+        tokens = asyncio.run(run(executor, data, read_size))
+        seconds = time.time() - start
+    assert tokens == expected == [('word', data[:-1]), ('space', b'\n')]
+    assert seconds < 20 * scan_seconds + 1, (seconds, scan_seconds)
+
+if __name__ == '__main__':
+    test()
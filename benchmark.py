@@ -0,0 +1,326 @@
+"""Rough benchmarks for pyflex.
+
+Run one with `python benchmark.py <name>`, or with no arguments to list them.
+"""
+import os, sys, time, shutil, tempfile
+import subprocess as sp
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+whitespace_patterns = [
+    ('token', r'[^ \t\r\n]+', True),
+    ('line_end', r'[\r\n]+', True)
+]
+
+def timed(fn, *args, **kwargs):
+    start = time.time()
+    res = fn(*args, **kwargs)
+    return time.time() - start, res
+
+def report(name, seconds, count=None, unit='tokens'):
+    if count is None:
+        print('%-32s %8.3fs' % (name, seconds))
+    else:
+        print('%-32s %8.3fs %12.0f %s/s' % (name, seconds, count / seconds, unit))
+
+def bench_compile(runs=5):
+    "cold vs warm scanner startup, each in a fresh process"
+    cache = tempfile.mkdtemp(prefix='pyflex-bench-')
+    env = dict(os.environ, PYFLEX_CACHE_DIR=cache)
+    script = 'import pyflex; pyflex.compile(%r)' % (whitespace_patterns,)
+    def run():
+        sp.check_call([sys.executable, '-c', script], cwd=here, env=env)
+    try:
+        seconds, _ = timed(run)
+        report('cold compile', seconds)
+        seconds, _ = timed(lambda: [run() for i in range(runs)])
+        report('warm start (avg of %d)' % runs, seconds / runs)
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+
+def make_corpus(n_words=1000000, words_per_line=12):
+    import random
+    rng = random.Random(42)
+    vocab = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for j in range(rng.randint(1, 10)))
+             for i in range(5000)]
+    lines = []
+    for i in range(0, n_words, words_per_line):
+        lines.append(' '.join(rng.choice(vocab) for j in range(words_per_line)))
+    return '\n'.join(lines) + '\n'
+
+def bench_batch():
+    "tokens/sec of next_token per call vs the batched ScannerIter vs the Scanner type"
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    corpus = make_corpus()
+
+    def single():
+        handle = sm.scanner.scan_string(corpus.encode('utf-8'), True)
+        next_token = sm.scanner.next_token
+        n = 0
+        try:
+            while True:
+                next_token(handle)
+                n += 1
+        except StopIteration:
+            pass
+        return n
+
+    def batched():
+        n = 0
+        for token in pyflex.ScannerIter(sm.scanner, sm.scanner.scan_string(corpus.encode('utf-8'), True)):
+            n += 1
+        return n
+
+    def native():
+        n = 0
+        for token in sm.scan_string(corpus):
+            n += 1
+        return n
+
+    seconds, n = timed(single)
+    report('next_token', seconds, n)
+    seconds, n = timed(batched)
+    report('next_tokens via ScannerIter', seconds, n)
+    seconds, n = timed(native)
+    report('Scanner tp_iternext', seconds, n)
+
+def bench_batch_actions(n_docs=16):
+    "scan_all MB/s with a yylex call per token vs batch actions scanning the input in one call"
+    import pyflex
+    docs = [make_corpus(200000) for i in range(n_docs)]
+    total = sum(len(doc) for doc in docs) / 1e6
+    for batch in (False, True):
+        sm = pyflex.compile(whitespace_patterns, batch=batch)
+        seconds, _ = timed(lambda: [sm.scan_all(doc) for doc in docs])
+        report('batch=%s' % batch, seconds, total, 'MB')
+
+def bench_token_batch(n_words=1000000):
+    "memory and time of a list of (kind, value) tuples vs a TokenBatch"
+    import tracemalloc
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    corpus = make_corpus(n_words)
+    for name, fn in [('list of tuples', lambda: list(sm.scan_string(corpus))),
+                     ('TokenBatch', lambda: sm.scan_batch(corpus))]:
+        tracemalloc.start()
+        seconds, res = timed(fn)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report(name, seconds, len(res))
+        print('%-32s %8.1f bytes/token' % ('', size / float(len(res))))
+        del res
+
+def bench_count(n_words=1000000):
+    "per-kind counts from iterating over tokens vs StateMachine.count"
+    import collections
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns, batch=True)
+    corpus = make_corpus(n_words)
+    seconds, counts = timed(lambda: collections.Counter(kind for kind, value in sm.scan_string(corpus)))
+    report('iterate', seconds, sum(counts.values()))
+    seconds, counts = timed(sm.count, corpus)
+    report('count', seconds, sum(counts.values()))
+
+def bench_intern(n_words=1000000, capacity=1 << 16):
+    "time and memory of keeping every token, with and without interned token values"
+    import tracemalloc
+    import pyflex
+    corpus = make_corpus(n_words)
+    for intern in (0, capacity):
+        sm = pyflex.compile(whitespace_patterns, intern=intern)
+        tracemalloc.start()
+        seconds, res = timed(lambda: list(sm.scan_string(corpus)))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        report('intern=%d' % intern, seconds, len(res))
+        print('%-32s %8.1f MB' % ('', size / 1e6))
+        del res
+
+def bench_small_docs(n_docs=200000):
+    "docs/sec on tweet sized documents: a scanner per document, the handle pool and scan_many"
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    docs = make_corpus(12 * n_docs).splitlines()
+    seconds, _ = timed(lambda: [list(sm.scan_string(doc)) for doc in docs])
+    report('scan_string', seconds, len(docs), 'docs')
+    seconds, _ = timed(lambda: [sm.tokenize(doc) for doc in docs])
+    report('tokenize (pooled)', seconds, len(docs), 'docs')
+    seconds, _ = timed(lambda: [list(batch) for batch in sm.scan_many(docs)])
+    report('scan_many', seconds, len(docs), 'docs')
+    seconds, _ = timed(sm.scan_many, docs, True)
+    report('scan_many(flat=True), no values', seconds, len(docs), 'docs')
+
+def bench_long_token(size_mb=16):
+    "MB/s on one long token: bytes copied into flex's buffer, a bytearray scanned in place and a stream fed 64K at a time"
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    data = b'x' * (size_mb * 1024 * 1024) + b'\n'
+    seconds, _ = timed(lambda: list(sm.scan_string(data)))
+    report('scan_string (copied)', seconds, size_mb, 'MB')
+    buf = bytearray(data + b'\0\0')
+    seconds, _ = timed(lambda: list(sm.scan_buffer(buf)))
+    report('scan_buffer (in place)', seconds, size_mb, 'MB')
+    def feed():
+        stream = sm.stream()
+        for i in range(0, len(data), 1 << 16):
+            stream.feed(data[i:i + (1 << 16)])
+        return stream.close()
+    seconds, _ = timed(feed)
+    report('stream feed', seconds, size_mb, 'MB')
+
+def count_offsets(it):
+    "drain an OffsetIter, returning how many tokens it produced"
+    from pyflex import offset_typecode
+    from array import array
+    out = array(offset_typecode, [0]) * (3 * 65536)
+    n = 0
+    while True:
+        k = it.fill(out)
+        if not k:
+            return n
+        n += k
+
+# files over 2 GiB are mapped but copied into flex's buffer in chunks, so
+# the default size stays under that to time the in-place scan
+def bench_mmap(size_mb=2000):
+    "scan_path with mmap vs reading through scan_file on a GB scale file"
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    chunk = make_corpus(200000)
+    fd, path = tempfile.mkstemp(prefix='pyflex-bench-')
+    try:
+        with os.fdopen(fd, 'w') as outf:
+            written = 0
+            while written < size_mb * 1024 * 1024:
+                outf.write(chunk)
+                written += len(chunk)
+        # the first pass pulls the file into the page cache for both
+        count_offsets(sm.scan_path(path, mmap=False, offsets=True))
+
+        with open(path) as inf:
+            seconds, n = timed(count_offsets, sm.scan_file(inf, offsets=True))
+        report('scan_file', seconds, written / 1e6, 'MB')
+        seconds, n = timed(count_offsets, sm.scan_path(path, offsets=True))
+        report('scan_path (mmap)', seconds, written / 1e6, 'MB')
+    finally:
+        os.unlink(path)
+
+def bench_threads(n_docs=64, max_workers=8):
+    "scan_all throughput over a thread pool as threads are added"
+    from concurrent.futures import ThreadPoolExecutor
+    import pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    docs = [make_corpus(50000) for i in range(n_docs)]
+    total = sum(len(doc) for doc in docs) / 1e6
+    workers = 1
+    while workers <= max_workers:
+        with ThreadPoolExecutor(workers) as pool:
+            seconds, _ = timed(lambda: list(pool.map(sm.scan_all, docs)))
+        report('%d threads' % workers, seconds, total, 'MB')
+        workers *= 2
+
+def bench_parallel(size_mb=256, max_processes=None):
+    "parallel.tokenize_files throughput over whitespace_tokenizer as processes are added"
+    import multiprocessing
+    import parallel
+    import whitespace_tokenizer
+    max_processes = max_processes or multiprocessing.cpu_count()
+    chunk = make_corpus(200000)
+    fd, path = tempfile.mkstemp(prefix='pyflex-bench-')
+    try:
+        with os.fdopen(fd, 'w') as outf:
+            written = 0
+            while written < size_mb * 1024 * 1024:
+                outf.write(chunk)
+                written += len(chunk)
+        processes = 1
+        while processes <= max_processes:
+            seconds, n = timed(lambda: sum(1 for line in
+                parallel.tokenize_files(whitespace_tokenizer.tokenize, [path], processes)))
+            report('%d processes' % processes, seconds, written / 1e6, 'MB')
+            processes *= 2
+    finally:
+        os.unlink(path)
+
+def bench_fallback(n_words=200000):
+    "tokens/sec of the flex scanner vs the pure python re backend"
+    import pyflex
+    corpus = make_corpus(n_words)
+    for backend in ('flex', 're'):
+        sm = pyflex.compile(whitespace_patterns, backend=backend)
+        seconds, n = timed(lambda: sum(1 for token in sm.scan_string(corpus)))
+        report(backend, seconds, n)
+
+def bench_async(size_mb=256):
+    "scan_async over a local TCP server, with the worst event loop delay seen meanwhile"
+    import pyflex
+    import async_pyflex
+    sm = pyflex.compile(whitespace_patterns)
+    chunk = make_corpus(200000).encode('utf-8')
+    data = chunk * max(1, size_mb * 1024 * 1024 // len(chunk))
+    seconds, n, worst = async_pyflex.bench(sm, data)
+    report('scan_async', seconds, n)
+    print('worst event loop delay %.1fms' % (worst * 1000))
+
+def make_sentence_text(n_bytes, seed=42):
+    "sentences with abbreviation chains, urls, numbers and punctuation runs"
+    import random
+    rng = random.Random(seed)
+    words = ['ide', 'doma', 'je', 'bio', 'tu', 'Pero', 'Ana', 'Zagreb', 'prof.dr.J.Malkovich',
+             'www.example.com', 'npr.', 'itd.', 'III.', '2008.', '12,5', '"', '(', ')', ':', ',']
+    ends = ['.', '!', '?', '...', '?!', '!.?']
+    parts, size = [], 0
+    while size < n_bytes:
+        sentence = ' '.join(rng.choice(words) for i in range(rng.randint(3, 15)))
+        sentence = sentence[0].upper() + sentence[1:] + rng.choice(ends)
+        if rng.random() < 0.1:
+            sentence += '\n\n'
+        parts.append(sentence)
+        size += len(sentence) + 1
+    return ' '.join(parts)
+
+def bench_sentence_scaling(size_mb=50):
+    "sentence_orig tokenize tokens/sec as the document grows to size_mb, flat if linear (python 2)"
+    import logging
+    import sentence_orig
+    logging.disable(logging.WARNING)
+    for div in (8, 4, 2, 1):
+        text = make_sentence_text(size_mb * 1024 * 1024 // div)
+        seconds, n = timed(lambda: sum(1 for token in sentence_orig.Tokenizer().tokenize(text)))
+        report('tokenize %.1fMB' % (len(text) / 1048576.0), seconds, n)
+
+def dict_variant(cls):
+    "cls with a per-instance __dict__ in place of its __slots__"
+    names = set(cls.__slots__) | set(['__slots__', '__dict__', '__weakref__'])
+    return type(cls.__name__, cls.__bases__,
+                dict((k, v) for k, v in cls.__dict__.items() if k not in names))
+
+def bench_token(size_mb=8):
+    "bytes per sentence_orig.Token (its value not counted) and Tokens built per second, vs a __dict__ Token (python 2)"
+    import logging
+    import sentence_orig
+    logging.disable(logging.WARNING)
+    text = make_sentence_text(size_mb * 1024 * 1024).decode('utf-8')
+    words = list(sentence_orig.Tokenizer.iter_words(text))
+    for name, cls in [('Token with __dict__', dict_variant(sentence_orig.Token)),
+                      ('Token', sentence_orig.Token)]:
+        seconds, tokens = timed(lambda: [cls(word) for word in words])
+        report(name, seconds, len(tokens))
+        size = sum(sys.getsizeof(token) + (sys.getsizeof(token.__dict__) if hasattr(token, '__dict__') else 0)
+                   for token in tokens)
+        print('%.0f bytes per token' % (size / float(len(tokens))))
+        del tokens
+
+benchmarks = dict((k[len('bench_'):], v) for k, v in globals().items() if k.startswith('bench_'))
+
+def main(argv):
+    if not argv:
+        for name in sorted(benchmarks):
+            print('%-24s %s' % (name, benchmarks[name].__doc__))
+        return
+    for name in argv:
+        benchmarks[name]()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,21 +1,24 @@
 import re
 import tempfile
 import subprocess as sp
-import os, platform, sys, shutil
-from distutils import sysconfig
-from distutils.core import Extension
-from distutils.command.build_ext import build_ext
-from distutils.dist import Distribution
+import os, platform, sys, shutil, shlex
+import sysconfig
 from hashlib import sha1
-import importlib
-from site import USER_BASE
-from distutils.ccompiler import new_compiler
+from io import StringIO
+import importlib.util
+import errno
 
 current_dir = os.path.abspath(__file__).split('/')[:-1]
-if os.access('/'.join(current_dir), os.W_OK):
+if os.environ.get('PYFLEX_CACHE_DIR'):
+    scratch_dir = os.path.abspath(os.environ['PYFLEX_CACHE_DIR'])
+elif os.access('/'.join(current_dir), os.W_OK):
     scratch_dir = '/'.join(current_dir + ['.pyflex'])
 else:
-    scratch_dir = os.path.abspath('~/.pyflex')
+    scratch_dir = os.path.expanduser('~/.pyflex')
+
+# directories searched for extensions built ahead of time by
+# `python -m pyflex build`, before sys.path
+prebuilt_path = [d for d in os.environ.get('PYFLEX_PREBUILT_PATH', '').split(os.pathsep) if d]
 
 debug = True
 devnull = open('/dev/null', 'w')
@@ -28,17 +31,49 @@ else:
 
 #kwargs['cwd'] = sysconfig.PREFIX
 
-def compile_extension(c_fname, extension_name):
-    dist = Distribution(dict(
-        name=extension_name,
-        ext_modules=[Extension(extension_name, sources=[c_fname])]
-    ))
-    dist.script_args = ['build_ext', '--inplace', '--build-temp=%s' % scratch_dir]
-    dist.parse_command_line()
-    dist.run_commands()
-
-
-group_re = re.compile(r'\(\?\P\<(.+?)\>(.*?)\)')
+def config_command(name):
+    return shlex.split(os.environ.get(name) or sysconfig.get_config_var(name) or '')
+
+def compile_extension(c_fname, extension_name, build_dir):
+    """Compiles and links c_fname into an extension module in build_dir,
+    with the same compiler and flags the interpreter was built with."""
+    o_fname = os.path.join(build_dir, extension_name + '.o')
+    so_fname = os.path.join(build_dir, extension_name + sysconfig.get_config_var('EXT_SUFFIX'))
+    sp.check_call(config_command('CC') + config_command('CFLAGS') + config_command('CCSHARED') + [
+        '-I', sysconfig.get_paths()['include'],
+        '-c', c_fname, '-o', o_fname], **kwargs)
+    sp.check_call(config_command('LDSHARED') + [o_fname, '-o', so_fname], **kwargs)
+
+def flex_version():
+    """Fingerprint of the flex binary on the PATH.
+
+    Uses the resolved path, size and mtime rather than running
+    `flex --version`, so a warm start never has to spawn a process."""
+    path = shutil.which('flex')
+    if path is None:
+        return 'flex-missing'
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return '%s:%d:%d' % (path, st.st_size, int(st.st_mtime))
+
+def toolchain_id():
+    """Everything besides the grammar that can change the compiled scanner."""
+    return '\0'.join([
+        flex_version(),
+        os.environ.get('CC') or sysconfig.get_config_var('CC') or '',
+        sys.version,
+        platform.machine(),
+        sysconfig.get_config_var('SOABI') or ''])
+
+
+def load_extension(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+group_re = re.compile(r'\(\?P\<(.+?)\>(.*?)\)')
 
 def matchsplit(regex, inp):
     matches = regex.finditer(inp)
@@ -64,7 +99,7 @@ class BasicRule(BaseRule):
         self.name = name
         self.pattern = pattern
 
-    def get_definitons(self):
+    def get_definitions(self):
         return '%s\t%s\n' % (self.name, self.pattern)
 
 class CompoundRule(BaseRule):
@@ -84,6 +119,7 @@ class EmittingRule(BaseRule):
         self.defn = defn
         self.name = name
         self.pattern = pattern
+        self.kind_id = defn.register_kind(name)
 
     def get_actions(self):
         return '%s\t%%{%s%%}\n' % (self.pattern, self.defn.action_code(self.name))
@@ -100,7 +136,7 @@ def named_capture_group_rule(defn, name, pattern, emitting):
         i += 1
 
     for part in matchsplit(group_re, pattern):
-        if type(part) in (str, unicode):
+        if isinstance(part, str):
             add_rule(part)
         else:
             group_name = part.groups(1)
@@ -132,11 +168,17 @@ def new_rule(defn, rule):
 
 class PatternDefinition(object):
 
-    def __init__(self, patterns):
+    def __init__(self, patterns, batch=False):
+        """With batch set the scanner's actions also have a mode that appends
+        matches to a C array and carries on scanning rather than returning,
+        so scan_all tokenizes a whole input in a single yylex call."""
         self.patterns = patterns
+        self.batch = batch
         self.rules = []
         self.rules.sort(key=lambda v: v[0])
         self.rule = None
+        self.kind_names = []
+        self.kind_ids = {}
         self.do_assertions()
         self.build_rules()
 
@@ -170,6 +212,7 @@ class PatternDefinition(object):
         outf.write('%{\n')
         self.write_c_headers(outf)
         self.write_enum_definitions(outf)
+        self.write_context_definition(outf)
         outf.write('%}\n')
         outf.write(self.rule.get_definitions())
         outf.write('\n%%\n')
@@ -177,46 +220,259 @@ class PatternDefinition(object):
         outf.write('\n%%\n')
         self.write_tail(outf)
 
-    def compile(self):
+    def source(self):
+        if not hasattr(self, '_source'):
+            outf = StringIO()
+            self.write_flex(outf)
+            self._source = outf.getvalue()
+        return self._source
+
+    def cache_key(self):
+        "hash of the generated flex source plus the toolchain that builds it"
+        if not hasattr(self, '_cache_key'):
+            self._cache_key = sha1(('%s\0%s' % (self.source(), toolchain_id())).encode('utf-8')).hexdigest()
+        return self._cache_key
+
+    def build(self, build_dir):
+        with open(os.path.join(build_dir, self.l_filename()), 'w') as outf:
+            outf.write(self.source())
+        sp.check_call(['flex', self.l_filename()], cwd=build_dir, **kwargs)
+        compile_extension(
+                os.path.join(build_dir, self.c_filename()),
+                self.module_name(),
+                build_dir)
+
+    def publish(self):
+        """Builds into a private temp dir and renames it into the cache.
+
+        The rename is atomic, so concurrent workers either see a complete
+        cache entry or none at all. If another worker published first
+        we throw our build away and use theirs."""
+        build_dir = tempfile.mkdtemp(prefix='build-', dir=scratch_dir)
+        try:
+            self.build(build_dir)
+            try:
+                os.rename(build_dir, self.cache_dir())
+            except OSError as e:
+                if e.errno not in (errno.EEXIST, errno.ENOTEMPTY) or not os.path.exists(self.so_filename()):
+                    raise
+        finally:
+            if os.path.exists(build_dir):
+                shutil.rmtree(build_dir, ignore_errors=True)
+
+    def ensure_cached(self):
         if not os.path.exists(scratch_dir):
-            os.mkdir(scratch_dir)
-        if True or not os.path.exists(self.so_filename()):
-            with open(self.l_filename(), 'w') as outf:
-                self.write_flex(outf)
-            sp.check_call(['flex', self.l_filename()], **kwargs)
-            compile_extension(self.c_filename(), '_%s' % self.hash())
-
-        if scratch_dir not in sys.path:
-            sys.path.append(scratch_dir)
-        return importlib.import_module('_%s' % self.hash())
+            try:
+                os.makedirs(scratch_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if not os.path.exists(self.so_filename()):
+            self.publish()
+
+    def find_prebuilt(self, search_path=()):
+        """Path of an extension for this grammar built ahead of time, looked
+        for in search_path, prebuilt_path and sys.path, or None. The file
+        name has a hash of the grammar, the C template and the batch option,
+        and the interpreter's ABI suffix, so it only matches a build of the
+        same grammar by this c_pyflex, with the same options, for this
+        interpreter."""
+        filename = self.module_name() + sysconfig.get_config_var('EXT_SUFFIX')
+        for d in list(search_path) + prebuilt_path + sys.path:
+            path = os.path.join(d or os.curdir, filename)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def build_prebuilt(self, out_dir):
+        """Builds this grammar (or reuses the cached build) and copies the
+        generated C file and the extension into out_dir, where compile()
+        finds it without needing flex or a compiler. Returns the
+        extension's path."""
+        self.ensure_cached()
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        shutil.copy(os.path.join(self.cache_dir(), self.c_filename()), out_dir)
+        return shutil.copy(self.so_filename(), out_dir)
+
+    def compile(self, search_path=()):
+        path = self.find_prebuilt(search_path)
+        if path is None:
+            self.ensure_cached()
+            path = self.so_filename()
+        return load_extension(self.module_name(), path)
 
     def write_head(self, outf):
-        outf.write('%option reentrant stack noyywrap full\n')
+        outf.write('%option reentrant stack noyywrap full 8bit\n')
+        outf.write('%option extra-type="struct parse_context *"\n')
         outf.write('%%option outfile="%s" header-file="%s"\n' % (self.c_filename(), self.h_filename()))
 
-    def write_enum_definitions(self, outf):
-        for k in self.keys():
-            outf.write('PyObject *result_token_%s;\n' % k)
-
-    def action_code(self, name):
-        return 'return Py_BuildValue("(Os)", result_token_%s, yytext);' % name
+    def register_kind(self, name):
+        "called by emitting rules. returns the kind id the scanner reports for them"
+        self.kind_ids[name] = len(self.kind_names)
+        self.kind_names.append(name)
+        return self.kind_ids[name]
 
-    def write_module_definition(self, outf):
+    def write_enum_definitions(self, outf):
+        for k in self.kind_names:
+            outf.write('#define TOKEN_%s %d\n' % (k, self.kind_ids[k]))
+        outf.write('#define N_TOKEN_KINDS %d\n' % len(self.kind_names))
+        outf.write('static const char *kind_names[N_TOKEN_KINDS + 1] = {%s0};\n' % ''.join(
+            '"%s", ' % k for k in self.kind_names))
+        # per-module state, so the module can be loaded in several (sub)interpreters.
+        # a token's kind is reported as its rule name or its id
+        outf.write('typedef struct module_state {\n')
+        outf.write('    PyObject *token_kinds[N_TOKEN_KINDS + 1];\n')
+        outf.write('    PyObject *token_ids[N_TOKEN_KINDS + 1];\n')
+        outf.write('    PyObject *scanner_type;\n')
+        outf.write('    struct intern_table *interned; /* shared by the handles that intern token values */\n')
+        outf.write('} module_state;\n')
+
+    def write_context_definition(self, outf):
         outf.write('''
     typedef struct parse_context {
         yyscan_t scanner;
         YY_BUFFER_STATE buffer;
+        YY_BUFFER_STATE chunk_buffer; /* the buffer input is copied into a chunk at a time, kept across resets */
+        long long offset; /* bytes consumed so far. a match ends here */
+        Py_buffer view; /* the input of scan_buffer, kept alive for the handle's lifetime */
+        int has_view;
+        const char *input; /* view contents still to be copied into flex's buffer */
+        Py_ssize_t input_left;
+        FILE *file; /* owned by the handle, closed with it */
+        char *map; /* file mapping of scan_path */
+        size_t map_len;
+        int busy; /* set while a thread scans with the GIL released */
+        /* push mode: input fed so far that hasn't been turned into tokens */
+        int streaming;
+        int closed;
+        char *pending;
+        Py_ssize_t pending_len;
+        Py_ssize_t pending_cap;
+        long long pending_offset; /* stream offset of pending[0] */
+        int pending_bol; /* pending[0] starts a line, so ^ rules can match there */
+        Py_ssize_t pending_held; /* pending_len left by the last scan */
+        int starved; /* flex wanted to read past the data fed so far */
+        long long starved_at; /* stream offset of the match it was working on */
+        PyObject *module; /* the scanner module, whose state holds the kind objects */
+        PyObject **kinds; /* its token_kinds or token_ids */
+        int decode; /* return token values as str decoded from UTF-8 rather than bytes */
+        struct token_vector *vec; /* set while batch actions collect matches into it */
+        int vec_failed; /* a batch action ran out of memory */
+        long long *counts; /* set while batch actions count matches of each kind into it */
+        int intern; /* return token values from the module's intern table */
     } parse_context;
 
+    typedef struct token_vector {
+        long long *data; /* (kind, start, end) triples */
+        Py_ssize_t len;
+        Py_ssize_t cap;
+    } token_vector;
+
+    /* appends a match. returns -1 if it runs out of memory */
+    int push_token(token_vector *vec, int kind, long long start, long long end) {
+        if (vec->len + 3 > vec->cap) {
+            Py_ssize_t cap = vec->cap ? 2 * vec->cap : 3 * 4096;
+            long long *data = realloc(vec->data, cap * sizeof(long long));
+            if (!data) {
+                return -1;
+            }
+            vec->data = data;
+            vec->cap = cap;
+        }
+        vec->data[vec->len] = kind;
+        vec->data[vec->len+1] = start;
+        vec->data[vec->len+2] = end;
+        vec->len += 3;
+        return 0;
+    }
+
+    /* flex's YY_INPUT. buffers that can't be scanned in place and stream
+       input are copied into flex's own buffer one chunk at a time; files
+       go through stdio */
+    int read_input(parse_context *context, char *buf, int max_size, FILE *file) {
+        if (!context->file) {
+            int n = context->input_left < max_size ? (int) context->input_left : max_size;
+            memcpy(buf, context->input, n);
+            context->input += n;
+            context->input_left -= n;
+            if (n == 0 && context->streaming && !context->closed && !context->starved) {
+                context->starved = 1;
+                context->starved_at = context->offset;
+            }
+            return n;
+        }
+        int n;
+        errno = 0;
+        while ((n = fread(buf, 1, max_size, file)) == 0 && ferror(file)) {
+            if (errno != EINTR) {
+                return 0;
+            }
+            errno = 0;
+            clearerr(file);
+        }
+        return n;
+    }
+''')
+
+    def action_code(self, name):
+        if self.batch:
+            # while a vector is set the match is recorded and yylex keeps
+            # going, so it only returns at the end of the input
+            return ('if (yyextra->counts) { yyextra->counts[TOKEN_%s]++; } '
+                    'else if (yyextra->vec) { '
+                    'if (push_token(yyextra->vec, TOKEN_%s, yyextra->offset - yyleng, yyextra->offset) != 0) { '
+                    'yyextra->vec_failed = 1; yyterminate(); } '
+                    '} else { return TOKEN_%s; }' % (name, name, name))
+        return 'return TOKEN_%s;' % name
+
+    def module_template(self):
+        "C code of the module, with %(name)s for its name"
+        return '''
     const char *capsule_name = "c_pyflex.ParseContext";
 
-    void free_context(parse_context *inp_context) {
-        if (inp_context->buffer) {
+    /* drops the input of a context, keeping its flex scanner and chunk buffer */
+    void release_input(parse_context *inp_context) {
+        if (inp_context->buffer && inp_context->buffer != inp_context->chunk_buffer) {
             yy_delete_buffer(inp_context->buffer, inp_context->scanner);
         }
+        inp_context->buffer = 0;
+        if (inp_context->has_view) {
+            PyBuffer_Release(&inp_context->view);
+            inp_context->has_view = 0;
+        }
+        if (inp_context->file) {
+            fclose(inp_context->file);
+            inp_context->file = 0;
+        }
+        if (inp_context->map) {
+            munmap(inp_context->map, inp_context->map_len);
+            inp_context->map = 0;
+            inp_context->map_len = 0;
+        }
+        inp_context->input = 0;
+        inp_context->input_left = 0;
+        inp_context->offset = 0;
+        inp_context->streaming = 0;
+        inp_context->closed = 0;
+        inp_context->pending_len = 0;
+        inp_context->pending_offset = 0;
+        inp_context->pending_bol = 1;
+        inp_context->pending_held = 0;
+        inp_context->starved = 0;
+        inp_context->starved_at = 0;
+    }
+
+    void free_context(parse_context *inp_context) {
+        release_input(inp_context);
+        if (inp_context->chunk_buffer) {
+            yy_delete_buffer(inp_context->chunk_buffer, inp_context->scanner);
+        }
         if (inp_context->scanner) {
             yylex_destroy(inp_context->scanner);
         }
+        free(inp_context->pending);
+        Py_XDECREF(inp_context->module);
         free(inp_context);
     }
 
@@ -224,51 +480,446 @@ class PatternDefinition(object):
         free_context((parse_context *) PyCapsule_GetPointer(capsule, capsule_name));
     }
 
+    parse_context *new_context(PyObject *module, int decode) {
+        parse_context *res_context = malloc(sizeof(parse_context));
+        if (!res_context) {
+            PyErr_NoMemory();
+            return 0;
+        }
+        res_context->buffer = 0;
+        res_context->chunk_buffer = 0;
+        res_context->offset = 0;
+        res_context->has_view = 0;
+        res_context->input = 0;
+        res_context->input_left = 0;
+        res_context->file = 0;
+        res_context->map = 0;
+        res_context->map_len = 0;
+        res_context->busy = 0;
+        res_context->streaming = 0;
+        res_context->closed = 0;
+        res_context->pending = 0;
+        res_context->pending_len = 0;
+        res_context->pending_cap = 0;
+        res_context->pending_offset = 0;
+        res_context->pending_bol = 1;
+        res_context->pending_held = 0;
+        res_context->starved = 0;
+        res_context->starved_at = 0;
+        res_context->module = module;
+        Py_INCREF(module);
+        res_context->kinds = ((module_state *) PyModule_GetState(module))->token_kinds;
+        res_context->decode = decode;
+        res_context->vec = 0;
+        res_context->vec_failed = 0;
+        res_context->counts = 0;
+        res_context->intern = 0;
+        if (yylex_init_extra(res_context, &res_context->scanner) != 0) {
+            Py_DECREF(module);
+            free(res_context);
+            PyErr_SetString(PyExc_RuntimeError, "failed to initialize flex");
+            return 0;
+        }
+        return res_context;
+    }
+
+    /* takes ownership of fd */
+    PyObject *stream_fd(PyObject *module, int fd, const char *mode, int decode) {
+        parse_context *res_context = new_context(module, decode);
+        if (!res_context) {
+            close(fd);
+            return 0;
+        }
+
+        res_context->file = fdopen(fd, mode);
+        if (!res_context->file) {
+            close(fd);
+            free_context(res_context);
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+        res_context->buffer = yy_create_buffer(res_context->file, INPUT_BUF_SIZE, res_context->scanner);
+        yy_switch_to_buffer(res_context->buffer, res_context->scanner);
+
+        return PyCapsule_New(res_context, capsule_name, free_context_capsule);
+    }
+
     PyObject *scan_file(PyObject *self, PyObject *args) {
-        yyscan_t scanner;
-        YY_BUFFER_STATE state;
         int fileno;
         char *mode;
+        int decode = 0;
 
-        if (!PyArg_ParseTuple(args, "is", &fileno, &mode)) {
+        if (!PyArg_ParseTuple(args, "is|p", &fileno, &mode, &decode)) {
             return 0;
         }
 
-        if (yylex_init(&scanner) != 0) {
-            PyErr_SetString(PyExc_RuntimeError, "failed to initialize flex");
+        /* read through our own copy of the descriptor so the caller's
+           file can still be closed independently of the handle */
+        int fd = dup(fileno);
+        if (fd < 0) {
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+        return stream_fd(self, fd, mode, decode);
+    }
+
+    /* makes a context without input copy buf into its chunk buffer as it
+       scans. touches no python objects. returns -1 if flex fails to make
+       the buffer */
+    int set_chunk_input(parse_context *inp_context, const char *buf, Py_ssize_t len) {
+        inp_context->input = buf;
+        inp_context->input_left = len;
+        if (!inp_context->chunk_buffer) {
+            inp_context->chunk_buffer = yy_create_buffer(0, INPUT_BUF_SIZE, inp_context->scanner);
+            if (!inp_context->chunk_buffer) {
+                return -1;
+            }
+        } else {
+            yy_flush_buffer(inp_context->chunk_buffer, inp_context->scanner);
+        }
+        inp_context->buffer = inp_context->chunk_buffer;
+        yy_switch_to_buffer(inp_context->buffer, inp_context->scanner);
+        return 0;
+    }
+
+    PyObject *scan_path(PyObject *self, PyObject *args) {
+        char *path;
+        int use_mmap = 1;
+        int decode = 0;
+        struct stat st;
+
+        if (!PyArg_ParseTuple(args, "s|pp", &path, &use_mmap, &decode)) {
             return 0;
         }
 
-        FILE *fileobj = fdopen(fileno, mode);
-        state = yy_create_buffer(fileobj, -1, scanner);
+        int fd = open(path, O_RDONLY);
+        if (fd < 0) {
+            return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+        }
+        if (!use_mmap || fstat(fd, &st) != 0 || !S_ISREG(st.st_mode)) {
+            /* pipes, fifos and devices can't be mapped */
+            return stream_fd(self, fd, "r", decode);
+        }
+
+        /* map the file copy-on-write (flex writes into the buffer it scans)
+           over an anonymous region two bytes longer than the file. the bytes
+           past the end are zero, which gives flex the two NULs it needs to
+           scan the whole file as a single buffer */
+        size_t size = (size_t) st.st_size;
+        size_t map_len = size + 2;
+        char *map = mmap(0, map_len, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+        if (map == MAP_FAILED) {
+            close(fd);
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+        if (size > 0) {
+            if (mmap(map, size, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_FIXED, fd, 0) == MAP_FAILED) {
+                close(fd);
+                munmap(map, map_len);
+                return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+            }
+            madvise(map, size, MADV_SEQUENTIAL);
+        }
+        close(fd);
 
-        parse_context *res_context = malloc(sizeof(parse_context));
-        res_context->scanner = scanner;
-        res_context->buffer = state;
+        parse_context *res_context = new_context(self, decode);
+        if (!res_context) {
+            munmap(map, map_len);
+            return 0;
+        }
+        res_context->map = map;
+        res_context->map_len = map_len;
+        if (size > INT_MAX - 2) {
+            /* flex keeps buffer sizes in an int, so a mapping this big is
+               copied into its chunk buffer instead */
+            set_chunk_input(res_context, map, size);
+        } else {
+            res_context->buffer = yy_scan_buffer(map, map_len, res_context->scanner);
+        }
+        if (!res_context->buffer) {
+            free_context(res_context);
+            PyErr_SetString(PyExc_RuntimeError, "failed to create flex buffer");
+            return 0;
+        }
 
         return PyCapsule_New(res_context, capsule_name, free_context_capsule);
     }
 
-    PyObject *scan_string(PyObject *self, PyObject *args) {
-        char *instring;
-        Py_ssize_t stringlen;
-        stringlen = 0;
-        if (!PyArg_ParseTuple(args, "s#", &instring, &stringlen)) {
+    /* makes a context without input scan the buffer of obj. returns -1
+       with a python error set on failure */
+    int set_buffer_input(parse_context *inp_context, PyObject *obj) {
+        /* flex writes into the buffer it scans (it NUL terminates yytext),
+           so only writable buffers can be scanned in place */
+        Py_buffer *view = &inp_context->view;
+        if (PyObject_GetBuffer(obj, view, PyBUF_WRITABLE) < 0) {
+            PyErr_Clear();
+            if (PyObject_GetBuffer(obj, view, PyBUF_SIMPLE) < 0) {
+                return -1;
+            }
+        }
+        inp_context->has_view = 1;
+
+        char *buf = (char *) view->buf;
+        /* flex keeps buffer sizes in an int, so bigger buffers are copied
+           a chunk at a time even if they could be scanned in place */
+        if (!view->readonly && view->len >= 2 && view->len <= INT_MAX &&
+                buf[view->len-2] == 0 && buf[view->len-1] == 0) {
+            /* already ends in the two NULs flex needs to scan it in place */
+            inp_context->buffer = yy_scan_buffer(buf, view->len, inp_context->scanner);
+        } else {
+            set_chunk_input(inp_context, buf, view->len);
+        }
+        if (!inp_context->buffer) {
+            PyErr_SetString(PyExc_RuntimeError, "failed to create flex buffer");
+            return -1;
+        }
+        return 0;
+    }
+
+    PyObject *scan_buffer(PyObject *self, PyObject *args) {
+        PyObject *obj;
+        int decode = 0;
+        if (!PyArg_ParseTuple(args, "O|p", &obj, &decode)) {
             return 0;
         }
-        yyscan_t scanner;
-        if (yylex_init(&scanner) != 0) {
-            PyErr_SetString(PyExc_RuntimeError, "failed to initialize flex");
+
+        parse_context *res_context = new_context(self, decode);
+        if (!res_context) {
+            return 0;
+        }
+        if (set_buffer_input(res_context, obj) != 0) {
+            free_context(res_context);
             return 0;
         }
 
-        YY_BUFFER_STATE buff = yy_scan_buffer(instring, stringlen-1, scanner);
+        return PyCapsule_New(res_context, capsule_name, free_context_capsule);
+    }
 
-        parse_context *res_context = malloc(sizeof(parse_context));
-        res_context->scanner = scanner;
-        res_context->buffer = buff;
+    parse_context *get_context(PyObject *capsule) {
+        parse_context *inp_context = (parse_context *) PyCapsule_GetPointer(capsule, capsule_name);
+        if (inp_context && inp_context->busy) {
+            PyErr_SetString(PyExc_RuntimeError, "scanner handle is being used by another thread");
+            return 0;
+        }
+        return inp_context;
+    }
 
-        return PyCapsule_New(res_context, capsule_name, free_context_capsule);
+    /* points an existing handle at a new buffer. the flex scanner and its
+       buffers are reused, so this is much cheaper than a new handle */
+    PyObject *reset(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        PyObject *obj;
+        int decode = 0;
+        if (!PyArg_ParseTuple(args, "OO|p", &capsule, &obj, &decode)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        release_input(inp_context);
+        inp_context->decode = decode;
+        if (set_buffer_input(inp_context, obj) != 0) {
+            return 0;
+        }
+        Py_RETURN_NONE;
+    }
+
+    /* token values seen recently, so a repeated token gives back the same
+       object rather than a new one. keyed by the token's bytes and whether
+       it was decoded, and bounded: past capacity entries the least recently
+       used is evicted. only touched with the GIL held */
+    typedef struct intern_entry {
+        char *key;
+        Py_ssize_t key_len;
+        int decode;
+        size_t hash;
+        PyObject *value;
+        struct intern_entry *chain; /* next in the bucket */
+        struct intern_entry *newer;
+        struct intern_entry *older;
+    } intern_entry;
+
+    typedef struct intern_table {
+        intern_entry **buckets;
+        size_t n_buckets; /* a power of two */
+        intern_entry *entries;
+        Py_ssize_t capacity;
+        Py_ssize_t used;
+        intern_entry *newest;
+        intern_entry *oldest;
+    } intern_table;
+
+    void free_intern_table(intern_table *table) {
+        Py_ssize_t i;
+        if (!table) {
+            return;
+        }
+        for (i = 0; i < table->used; i++) {
+            free(table->entries[i].key);
+            Py_XDECREF(table->entries[i].value);
+        }
+        free(table->entries);
+        free(table->buckets);
+        free(table);
+    }
+
+    intern_table *new_intern_table(Py_ssize_t capacity) {
+        intern_table *table = (intern_table *) calloc(1, sizeof(intern_table));
+        if (!table) {
+            return 0;
+        }
+        table->n_buckets = 1;
+        while (table->n_buckets < 2 * (size_t) capacity) {
+            table->n_buckets *= 2;
+        }
+        table->buckets = (intern_entry **) calloc(table->n_buckets, sizeof(intern_entry *));
+        table->entries = (intern_entry *) calloc(capacity, sizeof(intern_entry));
+        table->capacity = capacity;
+        if (!table->buckets || !table->entries) {
+            free_intern_table(table);
+            return 0;
+        }
+        return table;
+    }
+
+    void intern_unlink(intern_table *table, intern_entry *entry) {
+        if (entry->newer) {
+            entry->newer->older = entry->older;
+        } else {
+            table->newest = entry->older;
+        }
+        if (entry->older) {
+            entry->older->newer = entry->newer;
+        } else {
+            table->oldest = entry->newer;
+        }
+    }
+
+    void intern_push(intern_table *table, intern_entry *entry) {
+        entry->newer = 0;
+        entry->older = table->newest;
+        if (table->newest) {
+            table->newest->newer = entry;
+        } else {
+            table->oldest = entry;
+        }
+        table->newest = entry;
+    }
+
+    /* returns a new reference to the value for text, from the table if it's there */
+    PyObject *intern_value(intern_table *table, const char *text, Py_ssize_t len, int decode) {
+        size_t hash = 14695981039346656037ULL; /* FNV-1a */
+        Py_ssize_t i;
+        for (i = 0; i < len; i++) {
+            hash = (hash ^ (unsigned char) text[i]) * 1099511628211ULL;
+        }
+        intern_entry **bucket = &table->buckets[hash & (table->n_buckets - 1)];
+        intern_entry *entry;
+        for (entry = *bucket; entry; entry = entry->chain) {
+            if (entry->hash == hash && entry->key_len == len && entry->decode == decode &&
+                    memcmp(entry->key, text, len) == 0) {
+                intern_unlink(table, entry);
+                intern_push(table, entry);
+                Py_INCREF(entry->value);
+                return entry->value;
+            }
+        }
+
+        PyObject *value = decode ?
+            PyUnicode_DecodeUTF8(text, len, "surrogateescape") :
+            PyBytes_FromStringAndSize(text, len);
+        if (!value) {
+            return 0;
+        }
+        char *key = (char *) malloc(len ? len : 1);
+        if (!key) {
+            /* the table is only a cache */
+            return value;
+        }
+        memcpy(key, text, len);
+
+        if (table->used < table->capacity) {
+            entry = &table->entries[table->used++];
+        } else {
+            entry = table->oldest;
+            intern_unlink(table, entry);
+            intern_entry **link = &table->buckets[entry->hash & (table->n_buckets - 1)];
+            while (*link != entry) {
+                link = &(*link)->chain;
+            }
+            *link = entry->chain;
+            free(entry->key);
+            Py_DECREF(entry->value);
+        }
+        entry->key = key;
+        entry->key_len = len;
+        entry->decode = decode;
+        entry->hash = hash;
+        Py_INCREF(value);
+        entry->value = value;
+        entry->chain = *bucket;
+        *bucket = entry;
+        intern_push(table, entry);
+        return value;
+    }
+
+    PyObject *intern_values(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        Py_ssize_t capacity;
+        if (!PyArg_ParseTuple(args, "On", &capsule, &capacity)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        module_state *state = (module_state *) PyModule_GetState(inp_context->module);
+        if (capacity > 0 && (!state->interned || state->interned->capacity != capacity)) {
+            intern_table *table = new_intern_table(capacity);
+            if (!table) {
+                return PyErr_NoMemory();
+            }
+            free_intern_table(state->interned);
+            state->interned = table;
+        }
+        inp_context->intern = capacity > 0;
+        Py_RETURN_NONE;
+    }
+
+    PyObject *build_token(parse_context *inp_context, int kind) {
+        PyObject *val;
+        Py_ssize_t len = (Py_ssize_t) yyget_leng(inp_context->scanner);
+        if (inp_context->intern && len <= INTERN_MAX_LEN) {
+            module_state *state = (module_state *) PyModule_GetState(inp_context->module);
+            val = intern_value(state->interned, yyget_text(inp_context->scanner), len, inp_context->decode);
+        } else if (inp_context->decode) {
+            val = PyUnicode_DecodeUTF8(yyget_text(inp_context->scanner), len, "surrogateescape");
+        } else {
+            val = PyBytes_FromStringAndSize(yyget_text(inp_context->scanner), len);
+        }
+        if (!val) {
+            return 0;
+        }
+        PyObject *res = PyTuple_Pack(2, inp_context->kinds[kind], val);
+        Py_DECREF(val);
+        return res;
+    }
+
+    PyObject *emit_ids(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        int ids;
+        if (!PyArg_ParseTuple(args, "Oi", &capsule, &ids)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        module_state *state = (module_state *) PyModule_GetState(inp_context->module);
+        inp_context->kinds = ids ? state->token_ids : state->token_kinds;
+        Py_RETURN_NONE;
     }
 
     PyObject *next_token(PyObject *self, PyObject *args) {
@@ -277,56 +928,804 @@ class PatternDefinition(object):
             return 0;
         }
 
-        parse_context *inp_context = (parse_context *) PyCapsule_GetPointer((PyObject *) capsule, capsule_name);
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
 
-        yy_switch_to_buffer(inp_context->buffer, inp_context->scanner);
-        PyObject *res = yylex(inp_context->scanner);
-        if (res == 0) {
+        int kind = yylex(inp_context->scanner);
+        if (kind < 0) {
             PyErr_SetNone(PyExc_StopIteration);
+            return 0;
+        }
+        return build_token(inp_context, kind);
+    }
+
+    PyObject *next_tokens(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        Py_ssize_t max_n;
+        Py_ssize_t i;
+        if (!PyArg_ParseTuple(args, "On", &capsule, &max_n)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+
+        PyObject *res = PyList_New(0);
+        if (!res) {
+            return 0;
+        }
+        for (i = 0; i < max_n; i++) {
+            int kind = yylex(inp_context->scanner);
+            if (kind < 0) {
+                break;
+            }
+            PyObject *token = build_token(inp_context, kind);
+            if (!token || PyList_Append(res, token) != 0) {
+                Py_XDECREF(token);
+                Py_DECREF(res);
+                return 0;
+            }
+            Py_DECREF(token);
+        }
+        return res;
+    }
+
+    PyObject *next_offsets(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        PyObject *out;
+        Py_buffer view;
+        if (!PyArg_ParseTuple(args, "OO", &capsule, &out)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        if (PyObject_GetBuffer(out, &view, PyBUF_WRITABLE) < 0) {
+            return 0;
+        }
+
+        long long *res = (long long *) view.buf;
+        Py_ssize_t max_n = view.len / (3 * sizeof(long long));
+        Py_ssize_t n = 0;
+        inp_context->busy = 1;
+        Py_BEGIN_ALLOW_THREADS
+        while (n < max_n) {
+            int kind = yylex(inp_context->scanner);
+            if (kind < 0) {
+                break;
+            }
+            res[3*n] = kind;
+            res[3*n+1] = inp_context->offset - yyget_leng(inp_context->scanner);
+            res[3*n+2] = inp_context->offset;
+            n++;
+        }
+        Py_END_ALLOW_THREADS
+        inp_context->busy = 0;
+        PyBuffer_Release(&view);
+        return PyLong_FromSsize_t(n);
+    }
+
+    PyObject *stream(PyObject *self, PyObject *args) {
+        int decode = 0;
+        if (!PyArg_ParseTuple(args, "|p", &decode)) {
+            return 0;
+        }
+
+        parse_context *res_context = new_context(self, decode);
+        if (!res_context) {
+            return 0;
         }
+        res_context->streaming = 1;
+        res_context->chunk_buffer = yy_create_buffer(0, INPUT_BUF_SIZE, res_context->scanner);
+        res_context->buffer = res_context->chunk_buffer;
+        yy_switch_to_buffer(res_context->buffer, res_context->scanner);
+
+        return PyCapsule_New(res_context, capsule_name, free_context_capsule);
+    }
+
+    /* yy_set_bol needs the scanner's globals in scope */
+    void set_bol(yyscan_t yyscanner, int at_bol) {
+        struct yyguts_t *yyg = (struct yyguts_t *) yyscanner;
+        yy_set_bol(at_bol);
+    }
+
+    /* scans the input fed so far. unless the stream is closed, the scan
+       stops at the first match that had to look past the end of the data
+       to decide where it ends. that match and everything after it is kept
+       to be scanned again with the next chunk, so only about one token of
+       input is held between feeds */
+    PyObject *scan_pending(parse_context *inp_context) {
+        PyObject *res = PyList_New(0);
+        if (!res) {
+            return 0;
+        }
+        inp_context->input = inp_context->pending;
+        inp_context->input_left = inp_context->pending_len;
+        inp_context->offset = inp_context->pending_offset;
+        inp_context->starved = 0;
+        yyrestart(0, inp_context->scanner);
+        /* yyrestart puts the scanner at the start of a line, where the
+           pending input only is if the last byte consumed was a new line */
+        set_bol(inp_context->scanner, inp_context->pending_bol);
+        while (1) {
+            int kind = yylex(inp_context->scanner);
+            if (kind < 0 || inp_context->starved) {
+                break;
+            }
+            PyObject *token = build_token(inp_context, kind);
+            if (!token || PyList_Append(res, token) != 0) {
+                Py_XDECREF(token);
+                Py_DECREF(res);
+                return 0;
+            }
+            Py_DECREF(token);
+        }
+
+        long long done = inp_context->starved ? inp_context->starved_at : inp_context->offset;
+        Py_ssize_t used = (Py_ssize_t) (done - inp_context->pending_offset);
+        if (used > 0) {
+            inp_context->pending_bol = inp_context->pending[used-1] == '\\n';
+        }
+        memmove(inp_context->pending, inp_context->pending + used, inp_context->pending_len - used);
+        inp_context->pending_len -= used;
+        inp_context->pending_offset = done;
+        inp_context->pending_held = inp_context->pending_len;
+        return res;
+    }
+
+    parse_context *get_stream_context(PyObject *capsule) {
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        if (!inp_context->streaming) {
+            PyErr_SetString(PyExc_TypeError, "not a stream handle");
+            return 0;
+        }
+        if (inp_context->closed) {
+            PyErr_SetString(PyExc_ValueError, "stream is closed");
+            return 0;
+        }
+        return inp_context;
+    }
+
+    PyObject *feed(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        PyObject *data;
+        Py_buffer view;
+        if (!PyArg_ParseTuple(args, "OO", &capsule, &data)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_stream_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        if (PyObject_GetBuffer(data, &view, PyBUF_SIMPLE) < 0) {
+            return 0;
+        }
+
+        Py_ssize_t len = inp_context->pending_len + view.len;
+        if (len > inp_context->pending_cap) {
+            Py_ssize_t cap = inp_context->pending_cap ? inp_context->pending_cap : 4096;
+            while (cap < len) {
+                cap *= 2;
+            }
+            char *pending = realloc(inp_context->pending, cap);
+            if (!pending) {
+                PyBuffer_Release(&view);
+                return PyErr_NoMemory();
+            }
+            inp_context->pending = pending;
+            inp_context->pending_cap = cap;
+        }
+        memcpy(inp_context->pending + inp_context->pending_len, view.buf, view.len);
+        inp_context->pending_len = len;
+        PyBuffer_Release(&view);
+
+        /* a scan starts over from pending[0], so rescanning a long unfinished
+           match on every small feed would take quadratic time. it waits
+           until the held input has doubled, which keeps feeding linear */
+        if (len < 2 * inp_context->pending_held) {
+            return PyList_New(0);
+        }
+        return scan_pending(inp_context);
+    }
+
+    PyObject *close_stream(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        if (!PyArg_ParseTuple(args, "O", &capsule)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_stream_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        inp_context->closed = 1;
+        return scan_pending(inp_context);
+    }
+
+    /* runs the scanner to the end of its input, appending a triple for every
+       match. touches no python objects so it can run without the GIL.
+       returns -1 if it runs out of memory */
+    int scan_into(parse_context *inp_context, token_vector *vec) {
+    #ifdef BATCH_ACTIONS
+        /* the actions push every match themselves, so one call scans it all */
+        inp_context->vec = vec;
+        inp_context->vec_failed = 0;
+        yylex(inp_context->scanner);
+        inp_context->vec = 0;
+        return inp_context->vec_failed ? -1 : 0;
+    #else
+        while (1) {
+            int kind = yylex(inp_context->scanner);
+            if (kind < 0) {
+                return 0;
+            }
+            if (push_token(vec, kind, inp_context->offset - yyget_leng(inp_context->scanner), inp_context->offset) != 0) {
+                return -1;
+            }
+        }
+    #endif
+    }
+
+    /* scan_into with the GIL released. sets a python error and returns -1 on failure */
+    int scan_released(parse_context *inp_context, token_vector *vec) {
+        int err;
+        inp_context->busy = 1;
+        Py_BEGIN_ALLOW_THREADS
+        err = scan_into(inp_context, vec);
+        Py_END_ALLOW_THREADS
+        inp_context->busy = 0;
+        if (err) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        return 0;
+    }
+
+    PyObject *scan_all(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        if (!PyArg_ParseTuple(args, "O", &capsule)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+
+        token_vector vec = {0, 0, 0};
+        PyObject *res = 0;
+        if (scan_released(inp_context, &vec) == 0) {
+            res = PyByteArray_FromStringAndSize((const char *) vec.data, vec.len * sizeof(long long));
+        }
+        free(vec.data);
+        return res;
+    }
+
+    /* splits the triples of vec into a uint16 array of kinds and int64
+       arrays of starts and ends. returns a tuple of bytearrays */
+    PyObject *build_columns(token_vector *vec) {
+        Py_ssize_t i;
+        Py_ssize_t n = vec->len / 3;
+        PyObject *kinds = PyByteArray_FromStringAndSize(0, n * sizeof(unsigned short));
+        PyObject *starts = PyByteArray_FromStringAndSize(0, n * sizeof(long long));
+        PyObject *ends = PyByteArray_FromStringAndSize(0, n * sizeof(long long));
+        if (!kinds || !starts || !ends) {
+            Py_XDECREF(kinds);
+            Py_XDECREF(starts);
+            Py_XDECREF(ends);
+            return 0;
+        }
+        unsigned short *kind_data = (unsigned short *) PyByteArray_AS_STRING(kinds);
+        long long *start_data = (long long *) PyByteArray_AS_STRING(starts);
+        long long *end_data = (long long *) PyByteArray_AS_STRING(ends);
+        for (i = 0; i < n; i++) {
+            kind_data[i] = (unsigned short) vec->data[3*i];
+            start_data[i] = vec->data[3*i+1];
+            end_data[i] = vec->data[3*i+2];
+        }
+        return Py_BuildValue("(NNN)", kinds, starts, ends);
+    }
+
+    /* like scan_all, but splits the matches into a uint16 array of kinds
+       and int64 arrays of starts and ends */
+    PyObject *scan_columns(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        if (!PyArg_ParseTuple(args, "O", &capsule)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+
+        token_vector vec = {0, 0, 0};
+        PyObject *res = 0;
+        if (scan_released(inp_context, &vec) == 0) {
+            res = build_columns(&vec);
+        }
+        free(vec.data);
         return res;
     }
 
+    /* scans every document in the sequence docs with one handle, without
+       the GIL. returns the kinds, starts and ends of scan_columns plus an
+       int64 array of n_docs + 1 bounds: the tokens of docs[i] are
+       bounds[i] to bounds[i+1]. offsets are from the start of each
+       document, or of their concatenation if flat is set */
+    PyObject *scan_many(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        PyObject *docs;
+        int flat = 0;
+        Py_ssize_t i;
+        Py_ssize_t n_views = 0;
+        if (!PyArg_ParseTuple(args, "OO|p", &capsule, &docs, &flat)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+        PyObject *seq = PySequence_Fast(docs, "docs must be a sequence");
+        if (!seq) {
+            return 0;
+        }
+        Py_ssize_t n_docs = PySequence_Fast_GET_SIZE(seq);
+        PyObject *bounds = PyByteArray_FromStringAndSize(0, (n_docs + 1) * sizeof(long long));
+        Py_buffer *views = (Py_buffer *) PyMem_Malloc((n_docs ? n_docs : 1) * sizeof(Py_buffer));
+        PyObject *res = 0;
+        if (!bounds || !views) {
+            if (bounds) {
+                PyErr_NoMemory();
+            }
+            goto done;
+        }
+        for (n_views = 0; n_views < n_docs; n_views++) {
+            if (PyObject_GetBuffer(PySequence_Fast_GET_ITEM(seq, n_views), &views[n_views], PyBUF_SIMPLE) < 0) {
+                goto done;
+            }
+        }
+
+        long long *bound_data = (long long *) PyByteArray_AS_STRING(bounds);
+        token_vector vec = {0, 0, 0};
+        int err = 0;
+        release_input(inp_context);
+        inp_context->busy = 1;
+        Py_BEGIN_ALLOW_THREADS
+        long long base = 0;
+        for (i = 0; i < n_docs && !err; i++) {
+            bound_data[i] = vec.len / 3;
+            err = set_chunk_input(inp_context, (const char *) views[i].buf, views[i].len);
+            if (!err) {
+                inp_context->offset = flat ? base : 0;
+                err = scan_into(inp_context, &vec);
+            }
+            base += views[i].len;
+        }
+        bound_data[n_docs] = vec.len / 3;
+        Py_END_ALLOW_THREADS
+        inp_context->busy = 0;
+        inp_context->input = 0;
+        inp_context->input_left = 0;
+        inp_context->offset = 0;
+
+        if (err) {
+            PyErr_NoMemory();
+        } else {
+            PyObject *columns = build_columns(&vec);
+            if (columns) {
+                res = Py_BuildValue("(OOOO)",
+                        PyTuple_GET_ITEM(columns, 0),
+                        PyTuple_GET_ITEM(columns, 1),
+                        PyTuple_GET_ITEM(columns, 2),
+                        bounds);
+                Py_DECREF(columns);
+            }
+        }
+        free(vec.data);
+
+    done:
+        for (i = 0; i < n_views; i++) {
+            PyBuffer_Release(&views[i]);
+        }
+        PyMem_Free(views);
+        Py_XDECREF(bounds);
+        Py_DECREF(seq);
+        return res;
+    }
+
+    /* counts the matches of each kind to the end of the input. touches
+       no python objects so it can run without the GIL */
+    void count_into(parse_context *inp_context, long long *counts) {
+    #ifdef BATCH_ACTIONS
+        inp_context->counts = counts;
+        yylex(inp_context->scanner);
+        inp_context->counts = 0;
+    #else
+        int kind;
+        while ((kind = yylex(inp_context->scanner)) >= 0) {
+            counts[kind]++;
+        }
+    #endif
+    }
+
+    PyObject *count_kinds(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        long long counts[N_TOKEN_KINDS + 1] = {0};
+        int i;
+        if (!PyArg_ParseTuple(args, "O", &capsule)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+
+        inp_context->busy = 1;
+        Py_BEGIN_ALLOW_THREADS
+        count_into(inp_context, counts);
+        Py_END_ALLOW_THREADS
+        inp_context->busy = 0;
+
+        PyObject *res = PyTuple_New(N_TOKEN_KINDS);
+        if (!res) {
+            return 0;
+        }
+        for (i = 0; i < N_TOKEN_KINDS; i++) {
+            PyObject *count = PyLong_FromLongLong(counts[i]);
+            if (!count) {
+                Py_DECREF(res);
+                return 0;
+            }
+            PyTuple_SET_ITEM(res, i, count);
+        }
+        return res;
+    }
+
+    /* iterator over the tokens of a scanner handle, so iterating
+       doesn't go through python code for every token */
+    typedef struct scanner_object {
+        PyObject_HEAD
+        PyObject *handle;
+        parse_context *context;
+    } scanner_object;
+
+    PyObject *scanner_iternext(scanner_object *self) {
+        if (!self->context) {
+            return 0;
+        }
+        if (self->context->busy) {
+            PyErr_SetString(PyExc_RuntimeError, "scanner handle is being used by another thread");
+            return 0;
+        }
+        int kind = yylex(self->context->scanner);
+        if (kind < 0) {
+            return 0;
+        }
+        return build_token(self->context, kind);
+    }
+
+    int scanner_traverse(scanner_object *self, visitproc visit, void *arg) {
+        Py_VISIT(self->handle);
+        Py_VISIT(Py_TYPE(self));
+        return 0;
+    }
+
+    int scanner_clear(scanner_object *self) {
+        Py_CLEAR(self->handle);
+        self->context = 0;
+        return 0;
+    }
+
+    void scanner_dealloc(scanner_object *self) {
+        PyTypeObject *type = Py_TYPE(self);
+        PyObject_GC_UnTrack(self);
+        scanner_clear(self);
+        type->tp_free(self);
+        Py_DECREF(type);
+    }
+
+    static PyType_Slot ScannerSlots[] = {
+        {Py_tp_doc, "Iterator over the (kind, value) tokens of a scanner handle"},
+        {Py_tp_iter, PyObject_SelfIter},
+        {Py_tp_iternext, scanner_iternext},
+        {Py_tp_traverse, scanner_traverse},
+        {Py_tp_clear, scanner_clear},
+        {Py_tp_dealloc, scanner_dealloc},
+        {0, NULL}
+    };
+
+    static PyType_Spec ScannerSpec = {
+        "%(name)s.Scanner",
+        sizeof(scanner_object),
+        0,
+    #ifdef Py_TPFLAGS_DISALLOW_INSTANTIATION
+        Py_TPFLAGS_DISALLOW_INSTANTIATION |
+    #endif
+        Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+        ScannerSlots
+    };
+
+    PyObject *iterate(PyObject *self, PyObject *args) {
+        PyObject *capsule;
+        if (!PyArg_ParseTuple(args, "O", &capsule)) {
+            return 0;
+        }
+
+        parse_context *inp_context = get_context(capsule);
+        if (!inp_context) {
+            return 0;
+        }
+
+        module_state *state = (module_state *) PyModule_GetState(self);
+        scanner_object *res = PyObject_GC_New(scanner_object, (PyTypeObject *) state->scanner_type);
+        if (!res) {
+            return 0;
+        }
+        Py_INCREF(capsule);
+        res->handle = capsule;
+        res->context = inp_context;
+        PyObject_GC_Track(res);
+        return (PyObject *) res;
+    }
+
     static PyMethodDef ScannerMethods[] = {
         {"scan_file", scan_file, METH_VARARGS, "Takes a file descriptor and returns a scanner handle"},
-        {"scan_string", scan_string, METH_VARARGS, "Takes a string and returns a scanner handle"},
+        {"scan_path", scan_path, METH_VARARGS, "Takes a path and returns a scanner handle. Regular files are memory mapped unless the second argument is false"},
+        {"scan_string", scan_buffer, METH_VARARGS, "Takes a string and returns a scanner handle"},
+        {"scan_buffer", scan_buffer, METH_VARARGS, "Takes any buffer-protocol object and returns a scanner handle that keeps it alive"},
+        {"intern_values", intern_values, METH_VARARGS, "Sets how many recent token values a scanner handle's module keeps to return again for repeated tokens, 0 to turn it off for the handle"},
+        {"reset", reset, METH_VARARGS, "Points a scanner handle at a new buffer, reusing its flex scanner"},
+        {"emit_ids", emit_ids, METH_VARARGS, "Sets whether a scanner handle reports token kinds as integer ids instead of rule names"},
+        {"iterate", iterate, METH_VARARGS, "Returns a Scanner iterating over the tokens of a scanner handle"},
         {"next_token", next_token, METH_VARARGS, "Gets the next match from a scanner handle"},
+        {"next_tokens", next_tokens, METH_VARARGS, "Gets a list of up to n matches from a scanner handle"},
+        {"next_offsets", next_offsets, METH_VARARGS, "Writes (kind, start, end) int64 triples into a writable buffer and returns how many"},
+        {"stream", stream, METH_VARARGS, "Returns a push mode scanner handle"},
+        {"feed", feed, METH_VARARGS, "Adds a chunk of input to a stream handle and returns the tokens it completes"},
+        {"close_stream", close_stream, METH_VARARGS, "Ends the input of a stream handle and returns the remaining tokens"},
+        {"scan_all", scan_all, METH_VARARGS, "Scans the rest of the input without the GIL. Returns a bytearray of int64 (kind, start, end) triples"},
+        {"scan_many", scan_many, METH_VARARGS, "Scans a sequence of buffers with one handle, without the GIL. Returns bytearrays of uint16 kinds, int64 starts and ends and int64 document bounds"},
+        {"count_kinds", count_kinds, METH_VARARGS, "Scans the rest of the input without the GIL. Returns a tuple of the number of matches of each kind"},
+        {"scan_columns", scan_columns, METH_VARARGS, "Scans the rest of the input without the GIL. Returns bytearrays of uint16 kinds, int64 starts and int64 ends"},
         {NULL, NULL, 0, NULL}
     };
 
-    PyMODINIT_FUNC init_%(hash)s(void) {
-        %(inits)s
-        (void) Py_InitModule("_%(hash)s", ScannerMethods);
+    int exec_module(PyObject *module) {
+        module_state *state = (module_state *) PyModule_GetState(module);
+        PyObject *kinds = PyTuple_New(N_TOKEN_KINDS);
+        if (!kinds) {
+            return -1;
+        }
+        int i;
+        for (i = 0; i < N_TOKEN_KINDS; i++) {
+            state->token_kinds[i] = PyUnicode_InternFromString(kind_names[i]);
+            state->token_ids[i] = PyLong_FromLong(i);
+            if (!state->token_kinds[i] || !state->token_ids[i]) {
+                Py_DECREF(kinds);
+                return -1;
+            }
+            Py_INCREF(state->token_kinds[i]);
+            PyTuple_SET_ITEM(kinds, i, state->token_kinds[i]);
+        }
+        if (PyModule_AddObject(module, "kinds", kinds) < 0) {
+            Py_DECREF(kinds);
+            return -1;
+        }
+        state->scanner_type = PyType_FromModuleAndSpec(module, &ScannerSpec, 0);
+        if (!state->scanner_type) {
+            return -1;
+        }
+        Py_INCREF(state->scanner_type);
+        if (PyModule_AddObject(module, "Scanner", state->scanner_type) < 0) {
+            Py_DECREF(state->scanner_type);
+            return -1;
+        }
+        return 0;
+    }
+
+    int traverse_module(PyObject *module, visitproc visit, void *arg) {
+        module_state *state = (module_state *) PyModule_GetState(module);
+        int i;
+        for (i = 0; i < N_TOKEN_KINDS; i++) {
+            Py_VISIT(state->token_kinds[i]);
+            Py_VISIT(state->token_ids[i]);
+        }
+        Py_VISIT(state->scanner_type);
+        return 0;
+    }
+
+    int clear_module(PyObject *module) {
+        module_state *state = (module_state *) PyModule_GetState(module);
+        int i;
+        for (i = 0; i < N_TOKEN_KINDS; i++) {
+            Py_CLEAR(state->token_kinds[i]);
+            Py_CLEAR(state->token_ids[i]);
+        }
+        Py_CLEAR(state->scanner_type);
+        free_intern_table(state->interned);
+        state->interned = 0;
+        return 0;
     }
-    ''' % dict(
-            hash=self.hash(),
-            inits='\n'.join('result_token_%s = PyString_FromString("%s"); Py_INCREF(result_token_%s);' % (k, k, k) for k in self.keys())))
+
+    void free_module(void *module) {
+        clear_module((PyObject *) module);
+    }
+
+    static PyModuleDef_Slot ModuleSlots[] = {
+        {Py_mod_exec, exec_module},
+    #ifdef Py_mod_multiple_interpreters
+        /* the scanner keeps no global state */
+        {Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED},
+    #endif
+        {0, NULL}
+    };
+
+    static struct PyModuleDef ScannerModule = {
+        PyModuleDef_HEAD_INIT,
+        "%(name)s",
+        "flex scanner generated by c_pyflex",
+        sizeof(module_state),
+        ScannerMethods,
+        ModuleSlots,
+        traverse_module,
+        clear_module,
+        free_module
+    };
+
+    PyMODINIT_FUNC PyInit_%(name)s(void) {
+        return PyModuleDef_Init(&ScannerModule);
+    }
+    '''
+
+    def write_module_definition(self, outf):
+        outf.write(self.module_template() % dict(name=self.module_name()))
 
     def write_c_headers(self, outf):
-        outf.write('#include <stdio.h>\n')
+        outf.write('#define PY_SSIZE_T_CLEAN\n')
         outf.write('#include <Python.h>\n')
-        outf.write('#define YY_DECL PyObject *yylex(yyscan_t yyscanner)\n')
+        outf.write('#include <stdio.h>\n')
+        outf.write('#include <errno.h>\n')
+        outf.write('#include <limits.h>\n')
+        outf.write('#include <fcntl.h>\n')
+        outf.write('#include <unistd.h>\n')
+        outf.write('#include <sys/mman.h>\n')
+        outf.write('#include <sys/stat.h>\n')
+        outf.write('#define YY_DECL int yylex(yyscan_t yyscanner)\n')
+        # kind ids start at 0, so the end of input is signalled with -1
+        outf.write('#define yyterminate() return -1\n')
+        outf.write('#define YY_USER_ACTION yyextra->offset += yyleng;\n')
+        outf.write('#define YY_INPUT(buf, result, max_size) result = read_input(yyextra, buf, max_size, yyin);\n')
+        # text a stream has to rescan once more input arrives mustn't be echoed twice
+        outf.write('#define ECHO do { if (!yyextra->starved && fwrite(yytext, (size_t) yyleng, 1, yyout)) {} } while (0)\n')
+        # flex buffer size for inputs that are streamed in rather than scanned in place
+        outf.write('#define INPUT_BUF_SIZE (1 << 18)\n')
+        # flex rescans the match it is in after every read into its buffer,
+        # so reads fill all the free space. the default 8K reads made a long
+        # token cost quadratic time, now the buffer doubles between reads
+        outf.write('#define YY_READ_BUF_SIZE INT_MAX\n')
+        # longer token values aren't interned, they rarely repeat
+        outf.write('#define INTERN_MAX_LEN 64\n')
+        if self.batch:
+            outf.write('#define BATCH_ACTIONS 1\n')
 
     def write_tail(self, outf):
         self.write_module_definition(outf)
 
+    def template(self):
+        "the generated C code that doesn't depend on the module's name"
+        outf = StringIO()
+        self.write_c_headers(outf)
+        self.write_enum_definitions(outf)
+        self.write_context_definition(outf)
+        outf.write(self.module_template())
+        return outf.getvalue()
+
     def hash(self):
+        # covers the C template and the batch option as well as the rules,
+        # so a prebuilt extension only matches if it was generated by this
+        # version of c_pyflex with the same options
         if not hasattr(self, '_hash'):
-            self._hash = sha1('%s\0%s' % (self.rule.get_definitions(), self.rule.get_actions())).hexdigest()
+            self._hash = sha1(('%s\0%s\0%s' % (
+                self.rule.get_definitions(), self.rule.get_actions(), self.template())).encode('utf-8')).hexdigest()
         return self._hash
 
+    def module_name(self):
+        return '_%s' % self.hash()
+
+    def cache_dir(self):
+        return os.path.join(scratch_dir, self.cache_key())
+
+    # the generated sources are named relative to the build dir so that
+    # the flex source (and so the cache key) doesn't depend on where it's built
+
     def c_filename(self):
-        return os.path.join(scratch_dir, '%s_scanner.c' % self.hash())
+        return '%s_scanner.c' % self.hash()
 
     def h_filename(self):
-        return os.path.join(scratch_dir, '%s_scanner.h' % self.hash())
+        return '%s_scanner.h' % self.hash()
 
     def l_filename(self):
-        return os.path.join(scratch_dir, '%s_scanner.l' % self.hash())
+        return '%s_scanner.l' % self.hash()
 
     def so_filename(self):
-        if platform.system == 'Windows':
-            suffix = 'dll'
-        else:
-            suffix = 'so'
-        return os.path.join(scratch_dir, '_%s.%s' % (self.hash(), suffix))
+        suffix = sysconfig.get_config_var('EXT_SUFFIX')
+        return os.path.join(self.cache_dir(), self.module_name() + suffix)
+
+def test_module_names():
+    "prebuilt extensions are only found for the same grammar, template and options"
+    patterns = [('word', '[a-z]+', True), ('other', '.|\\n', True)]
+    name = PatternDefinition(patterns).module_name()
+    assert PatternDefinition(list(patterns)).module_name() == name
+    assert PatternDefinition(patterns, batch=True).module_name() != name
+
+    class OtherTemplate(PatternDefinition):
+        def module_template(self):
+            return PatternDefinition.module_template(self) + '/* changed */'
+    defn = OtherTemplate(patterns)
+    assert defn.module_name() != name
+    out_dir = tempfile.mkdtemp(prefix='pyflex-test-')
+    try:
+        open(os.path.join(out_dir, name + sysconfig.get_config_var('EXT_SUFFIX')), 'w').close()
+        assert PatternDefinition(patterns).find_prebuilt([out_dir]) is not None
+        assert defn.find_prebuilt([out_dir]) is None
+        assert PatternDefinition(patterns, batch=True).find_prebuilt([out_dir]) is None
+    finally:
+        shutil.rmtree(out_dir)
+
+def test_large_file(size=(1 << 31) + 100):
+    """scan_path on a sparse file too big for flex's int buffer sizes,
+    mapped and read through stdio"""
+    import pyflex
+    from array import array
+    sm = pyflex.compile([
+        ('nul', '\\0{1,64}', True),
+        ('word', '[a-z]+', True),
+        ('other', '.|\\n', True)], backend='flex')
+    fd, path = tempfile.mkstemp(prefix='pyflex-test-')
+    try:
+        with os.fdopen(fd, 'wb') as outf:
+            outf.write(b'start')
+            outf.seek(size - 4)
+            outf.write(b'end\n')
+        out = array(pyflex.offset_typecode, [0]) * (3 * 65536)
+        for use_mmap in (True, False):
+            it = sm.scan_path(path, use_mmap, offsets=True)
+            n = 0
+            while True:
+                k = it.fill(out)
+                if not k:
+                    break
+                n += k
+                last = tuple(out[3*k-3:3*k])
+            # start, the runs of NULs, end and the line end
+            assert n == 1 + (size - 9 + 63) // 64 + 2, (use_mmap, n)
+            assert last == (sm.kind_ids['other'], size - 1, size), (use_mmap, last)
+    finally:
+        os.unlink(path)
+
+def test():
+    test_module_names()
+    if shutil.which('flex') is None:
+        print('flex not found, skipping the c_pyflex tests')
+        return
+    # minutes of scanning, so only when asked for
+    if os.environ.get('PYFLEX_TEST_LARGE'):
+        test_large_file()
+    else:
+        print('set PYFLEX_TEST_LARGE=1 to scan a file over 2 GiB')
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,80 @@
+"""Tokenizes a corpus across a process pool.
+
+fn is any module level function that takes a string and returns an iterable,
+like whitespace_tokenizer.tokenize or sentence.preprocess_words. Each worker
+loads fn, and so imports its module and the compiled scanner it builds,
+once at startup. The scanner comes out of the on-disk cache, which the
+parent fills by importing fn before the pool starts.
+
+Results come back in input order, streamed as the shards complete.
+"""
+import os
+from multiprocessing import Pool
+
+# bytes per file shard, and lines per shard for tokenize_lines
+shard_size = 16 << 20
+shard_lines = 10000
+encoding = 'utf-8'
+
+worker_fn = None
+
+def load(fn):
+    global worker_fn
+    worker_fn = fn
+
+def run_text(text):
+    return list(worker_fn(text))
+
+def run_shard(shard):
+    path, start, end = shard
+    with open(path, 'rb') as inf:
+        inf.seek(start)
+        # shards end on line boundaries, so they never split a character
+        return run_text(inf.read(end - start).decode(encoding))
+
+def shards(path, size=None):
+    "Splits path into (path, start, end) byte ranges of about size bytes that end on line boundaries"
+    size = size or shard_size
+    total = os.path.getsize(path)
+    with open(path, 'rb') as inf:
+        start = 0
+        while start < total:
+            inf.seek(min(start + size, total))
+            inf.readline()
+            end = min(inf.tell(), total)
+            yield path, start, end
+            start = end
+
+def line_chunks(lines, n):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= n:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def imap(fn, func, items, processes):
+    pool = Pool(processes, load, (fn,))
+    try:
+        for res in pool.imap(func, items):
+            for item in res:
+                yield item
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def tokenize_files(fn, paths, processes=None, size=None):
+    """Yields everything fn produces for each file in paths. Files are
+    split into line aligned shards of about size bytes, so one big file
+    is spread over all the workers too."""
+    return imap(fn, run_shard,
+            (shard for path in paths for shard in shards(path, size)),
+            processes)
+
+def tokenize_lines(fn, lines, processes=None, n=None):
+    """Yields everything fn produces for an iterable of lines (which keep
+    their line endings), tokenized n lines at a time."""
+    return imap(fn, run_text, line_chunks(lines, n or shard_lines), processes)
@@ -1,34 +1,431 @@
+import argparse
+import importlib
+import importlib.util
+import os
+import subprocess
+import sys
+import warnings
+from array import array
 import c_pyflex
+import re_pyflex
+
+# array typecode of the int64 triples written by the offset scan mode
+offset_typecode = 'q'
 
 class ScannerIter(object):
+    """Iterates over a handle through the capsule API, fetching tokens in
+    batches. StateMachine uses the generated module's Scanner type
+    instead, which does the same without running python code per token."""
 
-    def __init__(self, scanner, handle):
+    # tokens fetched from the scanner per C call
+    batch_size = 1024
+
+    def __init__(self, scanner, handle, batch_size=None):
         self.handle = handle
         self.scanner = scanner
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.buffer = []
+        self.idx = 0
+        self.done = False
 
     def __iter__(self):
         return self
 
-    def next(self):
-        return self.scanner.next_token(self.handle)
+    def fill(self):
+        self.buffer = self.scanner.next_tokens(self.handle, self.batch_size)
+        self.idx = 0
+        # a short batch means the scanner hit the end of its input
+        if len(self.buffer) < self.batch_size:
+            self.done = True
+
+    def __next__(self):
+        if self.idx >= len(self.buffer):
+            if self.done:
+                raise StopIteration
+            self.fill()
+            if not self.buffer:
+                raise StopIteration
+        res = self.buffer[self.idx]
+        self.idx += 1
+        return res
+
+class OffsetIter(object):
+    """Iterates over (kind_id, start, end) triples instead of (kind, value)
+    pairs. kind_id indexes the scanner's kinds and start/end are byte
+    offsets into the input, so no token text is copied."""
+
+    # triples fetched from the scanner per C call
+    batch_size = 1024
+
+    def __init__(self, scanner, handle, batch_size=None):
+        self.handle = handle
+        self.scanner = scanner
+        if batch_size is not None:
+            self.batch_size = batch_size
+
+    def fill(self, out):
+        """Writes as many triples as fit into out, which can be an
+        array(offset_typecode) or any other writable buffer of int64s.
+        Returns the number of triples written, 0 at the end of the input.
+        Nothing is allocated per token."""
+        return self.scanner.next_offsets(self.handle, out)
+
+    def __iter__(self):
+        out = array(offset_typecode, [0]) * (3 * self.batch_size)
+        while True:
+            n = self.fill(out)
+            for i in range(0, 3 * n, 3):
+                yield out[i], out[i + 1], out[i + 2]
+            if n < self.batch_size:
+                return
+
+class Stream(object):
+    """Push mode scanner. feed() it chunks of input as they arrive and it
+    returns the tokens completed so far, then close() returns the rest.
+    Matches that span chunk boundaries come out whole, and only the
+    unfinished tail of the input (about one token) is held between feeds.
+    That tail is scanned again from its start, so while it is long feed()
+    waits for it to double before scanning, and its tokens may come a few
+    feeds later."""
+
+    def __init__(self, scanner, handle):
+        self.handle = handle
+        self.scanner = scanner
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        return self.scanner.feed(self.handle, chunk)
+
+    def close(self):
+        return self.scanner.close_stream(self.handle)
+
+class TokenBatch(object):
+    """The tokens of a scan as columns rather than tuples: kinds is a
+    memoryview of uint16 kind ids, starts and ends are memoryviews of int64
+    byte offsets into source, which the batch keeps alive. That is 18 bytes
+    a token, and (kind, value) tuples are only built when indexed or
+    iterated over. Slicing returns a TokenBatch sharing the same memory.
+
+    The columns export the buffer protocol, so numpy.asarray(batch.kinds)
+    or numpy.frombuffer(batch.ends, numpy.int64) wrap them without copying.
+
+    A batch of several documents scanned together has bounds, an int64
+    memoryview where the tokens of document i are bounds[i] to bounds[i+1].
+    It is None otherwise."""
+
+    def __init__(self, kinds, starts, ends, source, names, decode=False, bounds=None):
+        self.kinds = kinds
+        self.starts = starts
+        self.ends = ends
+        self.bounds = bounds
+        if source is not None and not isinstance(source, (bytes, bytearray)):
+            # the offsets count bytes, also in buffers of wider items
+            source = memoryview(source).cast('B')
+        self.source = source
+        # what a token's kind is reported as: kind names or ids
+        self.names = names
+        self.decode = decode
+
+    @classmethod
+    def from_columns(cls, columns, source, names, decode=False):
+        "makes a batch from the bytearrays returned by a scanner's scan_columns or scan_many"
+        kinds, starts, ends = columns[:3]
+        bounds = memoryview(columns[3]).cast(offset_typecode) if len(columns) > 3 else None
+        return cls(memoryview(kinds).cast('H'),
+                   memoryview(starts).cast(offset_typecode),
+                   memoryview(ends).cast(offset_typecode),
+                   source, names, decode, bounds)
+
+    def document(self, i):
+        "the tokens of the i-th document of a batch with bounds"
+        return self[self.bounds[i]:self.bounds[i+1]]
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def value(self, i):
+        res = bytes(self.source[self.starts[i]:self.ends[i]])
+        if self.decode:
+            return res.decode('utf-8', 'surrogateescape')
+        return res
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return TokenBatch(self.kinds[i], self.starts[i], self.ends[i],
+                              self.source, self.names, self.decode)
+        return self.names[self.kinds[i]], self.value(i)
+
+    def __iter__(self):
+        for i in range(len(self.kinds)):
+            yield self.names[self.kinds[i]], self.value(i)
 
 class StateMachine(object):
 
-    def __init__(self, scanner):
+    # handles kept to be reset and reused by the calls that scan a whole
+    # input at once, so a small document doesn't cost a new flex scanner
+    pool_size = 8
+
+    def __init__(self, scanner, ids=False, intern=0):
         self.scanner = scanner
+        self.ids = ids
+        # how many recent token values to keep and return again for
+        # repeated tokens, 0 for a new object per token
+        self.intern = intern
+        # kinds[kind_id] is the name of the rule with that id
+        self.kinds = scanner.kinds
+        self.kind_ids = dict((name, i) for i, name in enumerate(self.kinds))
+        self.pool = []
+
+    def setup(self, handle):
+        if self.ids:
+            self.scanner.emit_ids(handle, True)
+        if self.intern:
+            self.scanner.intern_values(handle, self.intern)
+        return handle
+
+    def acquire(self, obj, decode=False):
+        """A handle scanning the buffer obj, from the pool if it has one.
+        Pass it to release() once done with it."""
+        try:
+            handle = self.pool.pop()
+        except IndexError:
+            return self.setup(self.scanner.scan_buffer(obj, decode))
+        try:
+            self.scanner.reset(handle, obj, decode)
+        except BaseException:
+            # the handle is still good, obj isn't
+            self.pool.append(handle)
+            raise
+        return handle
+
+    def release(self, handle):
+        if len(self.pool) < self.pool_size:
+            # so the pool doesn't keep the last input alive
+            self.scanner.reset(handle, b'')
+            self.pool.append(handle)
+
+    def iterator(self, handle, offsets):
+        self.setup(handle)
+        if offsets:
+            return OffsetIter(self.scanner, handle)
+        return self.scanner.iterate(handle)
+
+    def scan_file(self, inf, offsets=False):
+        "Token values are str for files opened in text mode, which must be UTF-8, and bytes otherwise"
+        return self.iterator(
+                self.scanner.scan_file(inf.fileno(), inf.mode, 'b' not in inf.mode),
+                offsets)
+
+    def scan_path(self, path, mmap=True, offsets=False, decode=False):
+        """Scans the file at path. Regular files are memory mapped and
+        scanned as one buffer, with no reads or buffer refills. Pipes and
+        other unmappable files, or mmap=False, are read in chunks. Files
+        over 2 GiB, more than flex can scan as one buffer, are mapped but
+        copied into flex's buffer a chunk at a time.
+        Token values are bytes, or str decoded from UTF-8 if decode is set."""
+        return self.iterator(
+                self.scanner.scan_path(path, mmap, decode),
+                offsets)
+
+    def stream(self, decode=False):
+        "Token values are bytes, or str decoded from UTF-8 if decode is set"
+        return Stream(self.scanner, self.setup(self.scanner.stream(decode)))
+
+    def scan_async(self, reader, executor=None):
+        "Async iterator over the tokens read from an asyncio.StreamReader. See async_pyflex"
+        import async_pyflex
+        return async_pyflex.scan_async(self, reader, executor)
+
+    def scan_string(self, string, offsets=False):
+        """Scans a str, as UTF-8, or bytes. Token values have the same type
+        as string, and offsets are byte offsets into its UTF-8 encoding."""
+        decode = isinstance(string, str)
+        if decode:
+            string = string.encode('utf-8')
+        return self.iterator(
+                self.scanner.scan_string(string, decode),
+                offsets)
+
+    def scan_buffer(self, obj, offsets=False, decode=False):
+        """Scans any buffer-protocol object (bytearray, memoryview, mmap ...)
+        without turning it into a string. The returned iterator keeps obj
+        alive.
+
+        A writable buffer whose last two bytes are NUL, like
+        bytearray(data + b'\\0\\0'), is scanned in place. flex needs that
+        terminator and writes into the buffer while scanning, so anything
+        else is copied into flex's own buffer a chunk at a time. So are
+        buffers over 2 GiB, flex can't scan those in one piece. Each copy
+        fills the free space of flex's buffer, which doubles when a token
+        outgrows it, so a long token still takes linear time.
+
+        Token values are bytes, or str decoded from UTF-8 if decode is set."""
+        return self.iterator(
+                self.scanner.scan_buffer(obj, decode),
+                offsets)
+
+    def scan_all(self, obj):
+        """Scans all of obj (a string or any buffer) with the GIL released
+        and returns the matches as a flat array(offset_typecode) of
+        (kind_id, start, end) triples. Threads calling this run the
+        scanner in parallel."""
+        if isinstance(obj, str):
+            obj = obj.encode('utf-8')
+        res = array(offset_typecode)
+        handle = self.acquire(obj)
+        try:
+            res.frombytes(self.scanner.scan_all(handle))
+        finally:
+            self.release(handle)
+        return res
+
+    def scan_many(self, docs, flat=False):
+        """Scans a list of documents (strings or buffers) in one call, with
+        one scanner and the GIL released. Returns a list with a TokenBatch
+        per document; their columns are slices of the same arrays. With flat
+        set returns one TokenBatch over the documents joined together, with
+        the tokens of each document given by its bounds.
+
+        Token values are str if the documents are, and bytes otherwise, so
+        a list mixing the two is a TypeError."""
+        decode = bool(docs) and isinstance(docs[0], str)
+        if any(isinstance(doc, str) != decode for doc in docs):
+            raise TypeError('docs must be all str or all buffers, not a mix')
+        if decode:
+            docs = [doc.encode('utf-8') for doc in docs]
+        names = range(len(self.kinds)) if self.ids else self.kinds
+        handle = self.acquire(b'')
+        try:
+            columns = self.scanner.scan_many(handle, docs, flat)
+        finally:
+            self.release(handle)
+        if flat:
+            return TokenBatch.from_columns(columns, b''.join(docs), names, decode)
+        batch = TokenBatch.from_columns(columns, None, names, decode)
+        res = []
+        for i, doc in enumerate(docs):
+            part = batch.document(i)
+            res.append(TokenBatch(part.kinds, part.starts, part.ends, doc, names, decode))
+        return res
+
+    def tokenize(self, obj):
+        """The tokens of obj (a string or any buffer) as a list. Token values
+        have the same type as obj, or are bytes for buffers. Meant for lots
+        of small documents: the scanner comes from the pool."""
+        decode = isinstance(obj, str)
+        if decode:
+            obj = obj.encode('utf-8')
+        handle = self.acquire(obj, decode)
+        try:
+            return self.scanner.next_tokens(handle, sys.maxsize)
+        finally:
+            self.release(handle)
+
+    def count(self, obj):
+        """Counts the matches of each kind in obj (a string or any buffer)
+        with the GIL released, without building any tokens. Returns a dict
+        from kind (name, or id if ids is set) to count, zeros included."""
+        if isinstance(obj, str):
+            obj = obj.encode('utf-8')
+        handle = self.acquire(obj)
+        try:
+            counts = self.scanner.count_kinds(handle)
+        finally:
+            self.release(handle)
+        names = range(len(self.kinds)) if self.ids else self.kinds
+        return dict(zip(names, counts))
+
+    def scan_batch(self, obj):
+        """Scans all of obj (a string or any buffer) with the GIL released
+        and returns the matches as a TokenBatch. Token values are str if obj
+        is, and bytes otherwise. Offsets are into obj's UTF-8 encoding."""
+        decode = isinstance(obj, str)
+        if decode:
+            obj = obj.encode('utf-8')
+        names = range(len(self.kinds)) if self.ids else self.kinds
+        handle = self.acquire(obj)
+        try:
+            columns = self.scanner.scan_columns(handle)
+        finally:
+            self.release(handle)
+        return TokenBatch.from_columns(columns, obj, names, decode)
+
+
+def compile(patterns, ids=False, prebuilt=(), backend='auto', batch=False, intern=0):
+    """Compiles patterns into a StateMachine. Every emitting rule gets an
+    integer id, its position among the emitting rules in patterns, and
+    StateMachine.kinds maps ids back to names. With ids=True tokens are
+    reported as (kind_id, value) rather than (name, value).
+
+    A scanner built ahead of time with `python -m pyflex build` is used if
+    one is found in the prebuilt directories, c_pyflex.prebuilt_path or
+    sys.path. Otherwise it comes from the on-disk cache, or is built.
+
+    backend is 'flex' for the compiled scanner, 're' for the pure python
+    one in re_pyflex, or 'auto' for the compiled scanner unless it can't
+    be built here (no flex or C compiler), in which case it warns and
+    falls back to re.
+
+    With batch set the flex scanner is generated so that scan_all runs
+    through the whole input in a single yylex call, its actions collecting
+    matches into a C array, which is faster for grammars of short tokens.
+    The token at a time APIs work the same either way.
+
+    With intern set to a number of entries, token values come from a table
+    of the values seen most recently, so a repeated token is the same str
+    or bytes object each time rather than a new one. The table is shared by
+    the StateMachine's scans and drops the least recently used value when
+    full. Tokens over 64 bytes are never interned."""
+    thunker = c_pyflex.PatternDefinition(patterns, batch)
+    if backend == 'flex':
+        thing = thunker.compile(prebuilt)
+    elif backend == 're':
+        thing = re_pyflex.ReScanner(thunker)
+    elif backend == 'auto':
+        try:
+            thing = thunker.compile(prebuilt)
+        except (OSError, subprocess.CalledProcessError) as e:
+            warnings.warn('could not build a flex scanner (%s), using the re backend' % e)
+            thing = re_pyflex.ReScanner(thunker)
+    else:
+        raise ValueError('unknown backend: %r' % backend)
+    return StateMachine(thing, ids, intern)
 
-    def scan_file(self, inf):
-        return ScannerIter(
-                self.scanner,
-                self.scanner.scan_file(inf.fileno(), inf.mode))
+def load_patterns(spec):
+    "loads the pattern list named by 'path/to/module.py:name' or 'package.module:name'"
+    target, name = spec.rsplit(':', 1)
+    if target.endswith('.py'):
+        target = os.path.abspath(target)
+        sys.path.insert(0, os.path.dirname(target))
+        module_spec = importlib.util.spec_from_file_location(
+                os.path.basename(target)[:-len('.py')], target)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+    else:
+        module = importlib.import_module(target)
+    return getattr(module, name)
 
-    def scan_string(self, string):
-        return ScannerIter(
-                self.scanner,
-                self.scanner.scan_string(string))
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyflex')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    build = commands.add_parser('build',
+            help='build scanners ahead of time, e.g. to ship them in a wheel')
+    build.add_argument('patterns', nargs='+',
+            help='pattern lists to build, as module.py:name or package.module:name')
+    build.add_argument('-o', '--output', default='.',
+            help='directory to write the generated C files and extensions to. '
+                 'compile() finds them there if it is on sys.path or PYFLEX_PREBUILT_PATH')
+    build.add_argument('--batch', action='store_true',
+            help='build with batch actions, for compile(..., batch=True). '
+                 'intern needs no build option, it is set when scanning')
+    args = parser.parse_args(argv)
 
+    for spec in args.patterns:
+        thunker = c_pyflex.PatternDefinition(load_patterns(spec), args.batch)
+        print(thunker.build_prebuilt(args.output))
 
-def compile(patterns):
-    thunker = c_pyflex.PatternDefinition(patterns)
-    thing = thunker.compile()
-    return StateMachine(thing)
+if __name__ == '__main__':
+    main()
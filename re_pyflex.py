@@ -0,0 +1,647 @@
+"""Pure python backend for pyflex, for machines without flex or a C compiler.
+
+The rules are translated from flex's regex syntax to python's and matched
+with the re module, picking matches the way flex does: the longest match
+wins, ties go to the rule listed first, and input no rule matches is
+echoed to stdout. ReScanner has the same functions as a module generated
+by c_pyflex, so StateMachine works the same on top of either.
+
+re finds the first match of a pattern by trying its alternatives in order
+where flex finds the longest one, so a single rule like '"<"|"<="' matches
+'<' of '<=' here and '<=' under flex. With alternatives written longest
+first the two backends agree; differential_test checks that they do.
+"""
+import itertools
+import mmap
+import os
+import random
+import re
+import shutil
+import stat
+import sys
+import time
+from array import array
+
+from collections import OrderedDict
+
+import c_pyflex
+
+# flex's escapes. any other escaped character stands for itself, as in flex
+escapes = {'n': '\n', 't': '\t', 'r': '\r', 'f': '\f', 'v': '\v', 'a': '\a', 'b': '\b'}
+octal_digits = '01234567'
+hex_digits = '0123456789abcdefABCDEF'
+# longer token values aren't interned, like INTERN_MAX_LEN in the C scanner
+intern_max_len = 64
+
+posix_classes = {
+    'alnum': '0-9A-Za-z',
+    'alpha': 'A-Za-z',
+    'blank': ' \\t',
+    'cntrl': '\\x00-\\x1f\\x7f',
+    'digit': '0-9',
+    'graph': '\\x21-\\x7e',
+    'lower': 'a-z',
+    'print': '\\x20-\\x7e',
+    'punct': '!-/:-@\\[-`{-~',
+    'space': ' \\t\\n\\r\\f\\v',
+    'upper': 'A-Z',
+    'xdigit': '0-9A-Fa-f'}
+
+repeat_re = re.compile(r'\{\d+(,\d*)?\}')
+name_re = re.compile(r'\{([a-zA-Z_][a-zA-Z0-9_-]*)\}')
+
+def literal(c):
+    return '\\x%02x' % ord(c)
+
+def read_escape(p, i):
+    "reads the escape sequence whose backslash is at p[i-1]. returns (char, index after it)"
+    if i >= len(p):
+        raise ValueError('pattern ends with a backslash')
+    c = p[i]
+    if c in octal_digits:
+        j = i
+        while j < len(p) and j < i + 3 and p[j] in octal_digits:
+            j += 1
+        return chr(int(p[i:j], 8) & 0xff), j
+    if c == 'x' and p[i+1:i+2] and p[i+1] in hex_digits:
+        j = i + 1
+        while j < len(p) and j < i + 3 and p[j] in hex_digits:
+            j += 1
+        return chr(int(p[i+1:j], 16)), j
+    return escapes.get(c, c), i + 1
+
+def translate_class(p, i):
+    "translates the character class whose [ is at p[i-1]. returns (regex, index after the ])"
+    res = ['[']
+    if p[i:i+1] == '^':
+        res.append('^')
+        i += 1
+    first = True
+    while True:
+        if i >= len(p):
+            raise ValueError('unterminated character class')
+        c = p[i]
+        if c == ']' and not first:
+            res.append(']')
+            return ''.join(res), i + 1
+        first = False
+        if p.startswith('[:', i):
+            end = p.find(':]', i + 2)
+            name = p[i+2:end] if end > 0 else ''
+            if name not in posix_classes:
+                raise ValueError('unknown character class [:%s:]' % name)
+            res.append(posix_classes[name])
+            i = end + 2
+            continue
+        if c == '\\':
+            c, i = read_escape(p, i + 1)
+        else:
+            i += 1
+        if p[i:i+1] == '-' and p[i+1:i+2] not in ('', ']'):
+            hi = p[i+1]
+            i += 2
+            if hi == '\\':
+                hi, i = read_escape(p, i)
+            res.append('%s-%s' % (literal(c), literal(hi)))
+        else:
+            res.append(literal(c))
+
+def translate(pattern, definitions):
+    """Translates a flex pattern into python regex syntax, for matching bytes.
+    Returns (bol, body, trail): whether the pattern is anchored to the start
+    of a line, the regex for the matched text, and the regex for its
+    trailing context (after / or for $) or None."""
+    # flex works on the bytes of the pattern, so a non-ascii character is
+    # a sequence of literal bytes, in character classes too
+    p = pattern.encode('utf-8').decode('latin-1')
+    bol = p.startswith('^')
+    i = 1 if bol else 0
+    parts = []
+    trail = None
+    while i < len(p):
+        c = p[i]
+        if c == '"':
+            i += 1
+            chars = []
+            while True:
+                if i >= len(p):
+                    raise ValueError('unterminated string in %r' % pattern)
+                if p[i] == '"':
+                    break
+                if p[i] == '\\':
+                    ch, i = read_escape(p, i + 1)
+                else:
+                    ch = p[i]
+                    i += 1
+                chars.append(literal(ch))
+            parts.append('(?:%s)' % ''.join(chars))
+            i += 1
+        elif c == '\\':
+            ch, i = read_escape(p, i + 1)
+            parts.append(literal(ch))
+        elif c == '[':
+            part, i = translate_class(p, i + 1)
+            parts.append(part)
+        elif c == '{':
+            match = repeat_re.match(p, i)
+            if match:
+                parts.append(match.group())
+                i = match.end()
+                continue
+            match = name_re.match(p, i)
+            if not match:
+                raise ValueError('bad { in %r' % pattern)
+            if match.group(1) not in definitions:
+                raise ValueError('undefined definition {%s} in %r' % (match.group(1), pattern))
+            # flex puts expanded definitions in parentheses
+            parts.append('(?:%s)' % definitions[match.group(1)])
+            i = match.end()
+        elif c in '/$' and trail is not None:
+            raise ValueError('more than one trailing context in %r' % pattern)
+        elif c == '/':
+            trail = parts
+            parts = []
+            i += 1
+        elif c == '$' and i == len(p) - 1:
+            trail = parts
+            parts = [literal('\n')]
+            i += 1
+        elif c in '^$':
+            parts.append(literal(c))
+            i += 1
+        else:
+            parts.append(c)
+            i += 1
+    if trail is not None:
+        return bol, ''.join(trail), ''.join(parts)
+    return bol, ''.join(parts), None
+
+def as_bytes(obj):
+    "obj, or a view of it that re can match bytes patterns against"
+    if isinstance(obj, (bytes, bytearray, mmap.mmap)):
+        return obj
+    return memoryview(obj).cast('B')
+
+class Rule(object):
+
+    def __init__(self, kind_id, pattern, definitions):
+        self.kind_id = kind_id
+        bol, body, trail = translate(pattern, definitions)
+        if trail is None:
+            self.source = body
+        else:
+            # trailing context isn't part of the token, but it does count
+            # towards the length of the match when rules are compared
+            self.source = '%s(?=(%s))' % (body, trail)
+            self.trail_group = re.compile(body.encode('latin-1')).groups + 1
+        if bol:
+            self.source = '(?<![^\\n])(?:%s)' % self.source
+        self.trailing = trail is not None
+        self.regex = re.compile(self.source.encode('latin-1'))
+
+    def match(self, data, pos, end):
+        """(end of the token, end of the text matched with trailing context),
+        or None if the rule doesn't match at pos"""
+        match = self.regex.match(data, pos, end)
+        if match is None:
+            return None
+        if self.trailing:
+            return match.end(), match.end(self.trail_group)
+        return match.end(), match.end()
+
+class Handle(object):
+    "what the capsules of a generated module hold"
+
+    def __init__(self, scanner, decode):
+        self.kinds = scanner.token_kinds
+        self.decode = decode
+        self.intern = False
+        # (kind_id, start, end, value) for each match
+        self.matches = iter(())
+        self.streaming = False
+        self.closed = False
+        # the input not scanned yet, after the byte before it, which
+        # tells line anchored rules whether they are at a line start
+        self.pending = bytearray(b'\n')
+        self.pending_offset = 0
+        # input left by the last scan, which a stream rescans from the start
+        self.held = 0
+
+class ReScanner(object):
+    """Scans with the rules of a c_pyflex.PatternDefinition through the
+    re module. Has the functions of the module the definition compiles to."""
+
+    # bytes read from files at a time
+    read_size = 1 << 18
+    # a stream only decides matches with at least this much input after
+    # them, since the next chunk could complete a longer match. that is
+    # the same as flex unless a rule needs to look further ahead to match
+    holdback = 1024
+    # echo unmatched input to stdout, like flex's default rule
+    echo = True
+
+    def __init__(self, defn):
+        self.kinds = tuple(defn.kind_names)
+        self.token_kinds = self.kinds
+        self.token_ids = tuple(range(len(self.kinds)))
+        definitions = {}
+        self.rules = []
+        for rule in defn.rules:
+            if isinstance(rule, c_pyflex.EmittingRule):
+                self.rules.append(Rule(rule.kind_id, rule.pattern, definitions))
+            elif isinstance(rule, c_pyflex.BasicRule):
+                bol, body, trail = translate(rule.pattern, definitions)
+                if bol or trail is not None:
+                    raise ValueError('definition %s can not use ^, $ or /' % rule.name)
+                definitions[rule.name] = body
+            else:
+                raise ValueError('the re backend does not support %s' % type(rule).__name__)
+        # finds where the next match starts, and the first rule matching
+        # there. the rules after it may still match something longer
+        self.first = re.compile(b'|'.join(
+            ('(?P<r%d>%s)' % (i, rule.source)).encode('latin-1') for i, rule in enumerate(self.rules))
+            or b'(?!)')
+        self.rule_index = dict(('r%d' % i, i) for i in range(len(self.rules)))
+        self.interned = OrderedDict()
+        self.intern_capacity = 0
+
+    def write_echo(self, data, start, end):
+        if self.echo and start < end:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(bytes(data[start:end]))
+
+    def next_match(self, data, pos, end):
+        """The match flex makes at the first position at or after pos where a
+        rule matches, as (kind_id, start, end, seen), where seen is the end
+        of the text looked at, trailing context included. None if no rule
+        matches before end."""
+        match = self.first.search(data, pos, end)
+        while match is not None:
+            start = match.start()
+            best = None
+            for rule in self.rules[self.rule_index[match.lastgroup]:]:
+                res = rule.match(data, start, end)
+                if res is not None and (best is None or res[1] > best[2]):
+                    best = (rule.kind_id, res[0], res[1])
+            if best[1] > start:
+                return best[0], start, best[1], best[2]
+            # only empty matches here. flex echoes a character and moves on
+            match = self.first.search(data, start + 1, end)
+        return None
+
+    def scan(self, data, pos, end):
+        while True:
+            match = self.next_match(data, pos, end)
+            if match is None:
+                self.write_echo(data, pos, end)
+                return
+            kind, start, stop, seen = match
+            self.write_echo(data, pos, start)
+            yield kind, start, stop, bytes(data[start:stop])
+            pos = stop
+
+    def scan_pending(self, handle, final):
+        """Scans the input fed to a stream so far. Unless final is set, stops
+        at the first match within holdback bytes of the end of the data and
+        keeps it to scan again with the next chunk."""
+        data = handle.pending
+        end = len(data)
+        pos = 1
+        base = handle.pending_offset - 1
+        res = []
+        decided = end if final else end - self.holdback
+        while True:
+            match = self.next_match(data, pos, end)
+            if match is None:
+                stop = max(pos, decided)
+                self.write_echo(data, pos, stop)
+                pos = stop
+                break
+            kind, start, stop, seen = match
+            if not final and (stop > decided or seen >= end):
+                gap = min(start, max(pos, decided))
+                self.write_echo(data, pos, gap)
+                pos = gap
+                break
+            self.write_echo(data, pos, start)
+            res.append((kind, base + start, base + stop, bytes(data[start:stop])))
+            pos = stop
+        del data[:pos - 1]
+        handle.pending_offset += pos - 1
+        handle.held = len(data) - 1
+        return res
+
+    def read_fd(self, handle, fd):
+        try:
+            while True:
+                chunk = os.read(fd, self.read_size)
+                handle.pending += chunk
+                for match in self.scan_pending(handle, not chunk):
+                    yield match
+                if not chunk:
+                    return
+        finally:
+            os.close(fd)
+
+    def value(self, handle, text):
+        if handle.decode:
+            return text.decode('utf-8', 'surrogateescape')
+        return text
+
+    def intern_value(self, handle, text):
+        key = (text, handle.decode)
+        value = self.interned.get(key)
+        if value is not None:
+            self.interned.move_to_end(key)
+            return value
+        value = self.interned[key] = self.value(handle, text)
+        if len(self.interned) > self.intern_capacity:
+            self.interned.popitem(last=False)
+        return value
+
+    def build_token(self, handle, match):
+        if handle.intern and len(match[3]) <= intern_max_len:
+            return handle.kinds[match[0]], self.intern_value(handle, match[3])
+        return handle.kinds[match[0]], self.value(handle, match[3])
+
+    def scan_file(self, fileno, mode, decode=False):
+        "Takes a file descriptor and returns a scanner handle"
+        handle = Handle(self, decode)
+        # read through our own copy of the descriptor, like the C scanner
+        handle.matches = self.read_fd(handle, os.dup(fileno))
+        return handle
+
+    def scan_path(self, path, use_mmap=True, decode=False):
+        "Takes a path and returns a scanner handle. Regular files are memory mapped unless the second argument is false"
+        fd = os.open(path, os.O_RDONLY)
+        st = os.fstat(fd)
+        if not use_mmap or not stat.S_ISREG(st.st_mode) or st.st_size == 0:
+            handle = Handle(self, decode)
+            handle.matches = self.read_fd(handle, fd)
+            return handle
+        try:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return self.scan_buffer(data, decode)
+
+    def scan_buffer(self, obj, decode=False):
+        "Takes any buffer-protocol object and returns a scanner handle that keeps it alive"
+        handle = Handle(self, decode)
+        self.reset(handle, obj, decode)
+        return handle
+
+    def reset(self, handle, obj, decode=False):
+        "Points a scanner handle at a new buffer"
+        handle.decode = decode
+        handle.streaming = False
+        handle.closed = False
+        handle.pending = bytearray(b'\n')
+        handle.pending_offset = 0
+        handle.held = 0
+        data = as_bytes(obj)
+        end = len(data)
+        view = memoryview(data)
+        # the C scanner scans these in place, leaving out the two NULs
+        if not view.readonly and end >= 2 and data[end-2:end] == b'\0\0':
+            end -= 2
+        view.release()
+        handle.matches = self.scan(data, 0, end)
+
+    scan_string = scan_buffer
+
+    def intern_values(self, handle, capacity):
+        "Sets how many recent token values a scanner handle's module keeps to return again for repeated tokens, 0 to turn it off for the handle"
+        if capacity > 0 and capacity != self.intern_capacity:
+            self.interned = OrderedDict()
+            self.intern_capacity = capacity
+        handle.intern = capacity > 0
+
+    def emit_ids(self, handle, ids):
+        "Sets whether a scanner handle reports token kinds as integer ids instead of rule names"
+        handle.kinds = self.token_ids if ids else self.token_kinds
+
+    def iterate(self, handle):
+        "Returns an iterator over the tokens of a scanner handle"
+        return (self.build_token(handle, match) for match in handle.matches)
+
+    def next_token(self, handle):
+        "Gets the next match from a scanner handle"
+        return self.build_token(handle, next(handle.matches))
+
+    def next_tokens(self, handle, n):
+        "Gets a list of up to n matches from a scanner handle"
+        return [self.build_token(handle, match) for match in itertools.islice(handle.matches, n)]
+
+    def next_offsets(self, handle, out):
+        "Writes (kind, start, end) int64 triples into a writable buffer and returns how many"
+        view = memoryview(out).cast('B').cast('q')
+        n = 0
+        for kind, start, end, value in itertools.islice(handle.matches, len(view) // 3):
+            view[3*n] = kind
+            view[3*n+1] = start
+            view[3*n+2] = end
+            n += 1
+        view.release()
+        return n
+
+    def stream(self, decode=False):
+        "Returns a push mode scanner handle"
+        handle = Handle(self, decode)
+        handle.streaming = True
+        return handle
+
+    def get_stream(self, handle):
+        if not handle.streaming:
+            raise TypeError('not a stream handle')
+        if handle.closed:
+            raise ValueError('stream is closed')
+        return handle
+
+    def feed(self, handle, data):
+        "Adds a chunk of input to a stream handle and returns the tokens it completes"
+        self.get_stream(handle).pending += data
+        # as in the C module, the held input is rescanned once it has doubled
+        if len(handle.pending) - 1 < 2 * handle.held:
+            return []
+        return [self.build_token(handle, match) for match in self.scan_pending(handle, False)]
+
+    def close_stream(self, handle):
+        "Ends the input of a stream handle and returns the remaining tokens"
+        self.get_stream(handle).closed = True
+        return [self.build_token(handle, match) for match in self.scan_pending(handle, True)]
+
+    def scan_all(self, handle):
+        "Scans the rest of the input. Returns a bytearray of int64 (kind, start, end) triples"
+        res = array('q')
+        for kind, start, end, value in handle.matches:
+            res.append(kind)
+            res.append(start)
+            res.append(end)
+        return bytearray(res.tobytes())
+
+    def count_kinds(self, handle):
+        "Scans the rest of the input. Returns a tuple of the number of matches of each kind"
+        counts = [0] * len(self.kinds)
+        for kind, start, end, value in handle.matches:
+            counts[kind] += 1
+        return tuple(counts)
+
+    def scan_many(self, handle, docs, flat=False):
+        "Scans a sequence of buffers with one handle. Returns bytearrays of uint16 kinds, int64 starts and ends and int64 document bounds"
+        kinds = array('H')
+        starts = array('q')
+        ends = array('q')
+        bounds = array('q')
+        base = 0
+        for doc in docs:
+            bounds.append(len(kinds))
+            data = as_bytes(doc)
+            offset = base if flat else 0
+            # the C scanner copies every document, never scanning in place
+            for kind, start, end, value in self.scan(data, 0, len(data)):
+                kinds.append(kind)
+                starts.append(offset + start)
+                ends.append(offset + end)
+            base += len(data)
+        bounds.append(len(kinds))
+        return (bytearray(kinds.tobytes()), bytearray(starts.tobytes()),
+                bytearray(ends.tobytes()), bytearray(bounds.tobytes()))
+
+    def scan_columns(self, handle):
+        "Scans the rest of the input. Returns bytearrays of uint16 kinds, int64 starts and int64 ends"
+        kinds = array('H')
+        starts = array('q')
+        ends = array('q')
+        for kind, start, end, value in handle.matches:
+            kinds.append(kind)
+            starts.append(start)
+            ends.append(end)
+        return bytearray(kinds.tobytes()), bytearray(starts.tobytes()), bytearray(ends.tobytes())
+
+
+# grammars differential_test runs on. each ends in a rule matching any
+# character, so the flex scanner never echoes
+test_grammars = [
+    [('word', '[a-z]+', True),
+     ('number', '[0-9]+', True),
+     ('space', '[ \\t\\n]+', True),
+     ('other', '.|\\n', True)],
+    # longest match, ties go to the first rule
+    [('kw_if', '"if"', True),
+     ('ident', '[a-z]+', True),
+     ('op', '"<="|"<"|"="', True),
+     ('other', '.|\\n', True)],
+    # definitions, trailing context and line anchors
+    [('digit', '[0-9]'),
+     ('float', '{digit}+"."{digit}*', True),
+     ('int', '{digit}+', True),
+     ('comment', '^"#"[^\\n]*', True),
+     ('call', '[a-z]+/"("', True),
+     ('line_end', '[a-z]+$', True),
+     ('other', '.|\\n', True)],
+]
+
+test_alphabet = 'abfiz019 .<=(#\n\t!'
+
+def random_input(rng, length):
+    return ''.join(rng.choice(test_alphabet) for i in range(length)).encode('utf-8')
+
+def stream_tokens(sm, data, rng):
+    stream = sm.stream()
+    res = []
+    i = 0
+    while i < len(data):
+        n = rng.randint(1, 16)
+        res.extend(stream.feed(data[i:i+n]))
+        i += n
+    res.extend(stream.close())
+    return res
+
+def stream_bol_test(backend):
+    "^ rules match after a chunk that ends a line, not at every chunk boundary"
+    import pyflex
+    sm = pyflex.compile(test_grammars[2], backend=backend)
+    stream = sm.stream()
+    tokens = stream.feed(b'ab') + stream.feed(b'#x\n') + stream.feed(b'#y') + stream.close()
+    assert tokens == [
+            ('other', b'a'), ('other', b'b'), ('other', b'#'), ('line_end', b'x'),
+            ('other', b'\n'), ('comment', b'#y')], tokens
+
+def stream_long_token_test(backend, size=1 << 20, chunk=1000):
+    "feeding one long token in small chunks takes about as long as scanning it"
+    import pyflex
+    sm = pyflex.compile(test_grammars[0], backend=backend)
+    data = b'a' * size + b' '
+    start = time.time()
+    expected = list(sm.scan_string(data))
+    scan_seconds = time.time() - start
+    start = time.time()
+    stream = sm.stream()
+    tokens = []
+    for i in range(0, len(data), chunk):
+        tokens.extend(stream.feed(data[i:i+chunk]))
+    tokens.extend(stream.close())
+    stream_seconds = time.time() - start
+    assert tokens == expected == [('word', data[:-1]), ('space', b' ')]
+    # rescanning the held input on every feed took minutes here
+    assert stream_seconds < 20 * scan_seconds + 1, (stream_seconds, scan_seconds)
+
+def differential_test(patterns, n_inputs=200, max_length=200, seed=0):
+    """Checks that the flex and re backends produce the same tokens, offsets
+    and streamed tokens on random inputs. Needs flex and a C compiler."""
+    import pyflex
+    flex = pyflex.compile(patterns, backend='flex')
+    fallback = pyflex.compile(patterns, backend='re')
+    rng = random.Random(seed)
+    for i in range(n_inputs):
+        data = random_input(rng, rng.randint(0, max_length))
+        expected = list(flex.scan_string(data))
+        assert list(fallback.scan_string(data)) == expected, data
+        assert fallback.scan_all(data) == flex.scan_all(data), data
+        stream_seed = rng.random()
+        assert stream_tokens(fallback, data, random.Random(stream_seed)) == \
+                stream_tokens(flex, data, random.Random(stream_seed)) == expected, data
+
+def test():
+    import pyflex
+    sm = pyflex.compile(test_grammars[1], backend='re')
+    assert list(sm.scan_string('if iffy<=i')) == [
+            ('kw_if', 'if'), ('other', ' '), ('ident', 'iffy'), ('op', '<='), ('ident', 'i')]
+    sm = pyflex.compile(test_grammars[2], backend='re')
+    assert list(sm.scan_string(b'# x\nab(cd\n1.5 #')) == [
+            ('comment', b'# x'), ('other', b'\n'), ('call', b'ab'), ('other', b'('),
+            ('line_end', b'cd'), ('other', b'\n'), ('float', b'1.5'), ('other', b' '), ('other', b'#')]
+    assert stream_tokens(sm, b'# x\nab(cd\n1.5 #', random.Random(1)) == list(sm.scan_string(b'# x\nab(cd\n1.5 #'))
+    stream_bol_test('re')
+    stream_long_token_test('re')
+    # batch offsets are bytes, also into a buffer of wider items
+    words = pyflex.compile(test_grammars[0], backend='re')
+    data = array('H', b'ab cd ef')
+    expected = list(words.scan_buffer(data))
+    assert list(words.scan_batch(data)) == expected, list(words.scan_batch(data))
+    assert list(words.scan_many([data])[0]) == list(words.scan_many([data], flat=True)) == expected
+    try:
+        sm.scan_many(['ab', b'cd'])
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('scan_many took a mix of str and bytes')
+    # a handle whose reset fails goes back to the pool
+    sm.tokenize(b'ab')
+    try:
+        sm.tokenize(object())
+    except TypeError:
+        pass
+    assert len(sm.pool) == 1, sm.pool
+
+    if shutil.which('flex') is None:
+        print('flex not found, skipping the differential tests')
+        return
+    stream_bol_test('flex')
+    stream_long_token_test('flex')
+    for patterns in test_grammars:
+        differential_test(patterns)
+
+if __name__ == '__main__':
+    test()
@@ -1,78 +1,134 @@
-import flexparse
+import pyflex
 
 NOVALUE_WORD = "_%|"  # special value used for later recognition
 
+# flex port of sentence_orig.Tokenizer.preprocess_text: the scanner matches
+# the words preprocess_text(text).split() would give, so the rewritten text
+# is never built. flex works on UTF-8 bytes, non-ascii chars are spelled
+# out as byte sequences.
+#
+# One deliberate difference: a comma not between digits is always a word
+# of its own. sentence_orig's re.sub consumes the chars around a comma, so
+# a comma right after another match, or after a comma it just split, stays
+# glued to the next word - "),x" gives ",x" and "a,b,c" gives "b,c".
 
 patterns = []
 
-patterns.append(('CH_SENT_END', ".!?"))
-patterns.append(('RE_ONLY_SENT_END', '^[{CH_SENT_END}]+$'))
-patterns.append(('RE_STARTS_SENT_END', '^[{CH_SENT_END}]+'))
-patterns.append(('RE_SPLIT_SENT_END', '[{CH_SENT_END}]'))
-
-patterns.append(('RETXT_ALPHA', "[^\W\d_]"))
-patterns.append(('RE_CONTRACTION', "^{RETXT_ALPHA}+'{RETXT_ALPHA}*$"))
-
-# NUMBERS
-patterns.append(('RE_NUMBER', "^[+\-]?[\.,]?[0-9]+([\.,][0-9]+)*$"))
-patterns.append(('RE_ROMNR', "^(?P<M>M{1,3})?(?P<C>CM|DC{0,3}|CD|C{1,3})?(?P<X>XC|LX{0,3}|XL|X{1,3})?(?P<I>IX|VI{0,3}|IV|I{1,3})?$"))
-
-patterns.append(('RE_AFT_DOT_SENT_END_PUNC', "^[\'\-\/\(\)\"\*\+\!\?\.\#]+$")
-
-# sentence inner separators
-patterns.append(('CH_SENT_INSEP_OTHER' r"\#\:\;\-\&\/"))
-patterns.append(('CH_SENT_INSEP', r"\,\:\;\-\&\/"))
-#_RE_STARTS_SENT_INSEP = re.compile('^[%s]+' % _CH_SENT_INSEP, flags=re.UNICODE)
-
-# sub-sentence - no diff between start and end "", (), ...
-# TODO: i have problem with "nagnuti navodnik" and coding of this file
-#       »==\xbb, «==\xab
-patterns.append(('CH_SENT_SUB1', unicode(r'\"\Ëť\`»«”’ť', "utf-8")))
-# NOTE: ' -> ain't inner separator more: isn't -> one word -> isn't 
-# _CH_SENT_SUB1 = unicode(r'\"\'\Ëť\`»«”’ť', "utf-8")
-
-patterns.append(('CH_SENT_SUB2_START', r'\(\[\{')) # order of chars in start/end must be the same (==)
-patterns.append(('CH_SENT_SUB2_END', r'\)\]\}'))
+# blanks, as \s in sentence_orig, and new lines - one at a time, two or
+# more in a row are a paragraph
+patterns.append(('BLANK', r'[ \t\f\v]|\xc2\xa0'))
+patterns.append(('NL', r'[\n\r]'))
 
 # PARAGRAPH MARKUP
-# -------, ********, ======== etc. 
-_RETXT_PAR_START1   = r'(%s[\-\=\*\/\\\+\#]{5,})'
-_RETXT_PAR_START2   = '(%s[\n|\r\n]{2,})'
-
-# TAG MATCH 
-# matches something like this "$tag_name:opts:some-value$"
-# {'tag': 'tag_name', 'tag_options' : 'opts', 'value': 'some-value'}
-_RE_TAG = re.compile("^\$(?P<tag>\w+)\%(?P<tag_options>\S*)\%(?P<value>\S*)\$$")
-_RETXT_WRAP_TAG = "(?P<tag_spec>\$\w+\%\S*\%\S*\$)"
-# NOTE: order wrap_space / wrap_space_comma must be like this - probably greedy problem
-patterns.append(('RETXT_SENT_DO_WRAP',  '{RETXT_WRAP_TAG}|%s|%s|(?P<wrap_space>[{CH_SENT_INSEP_OTHER}]|[{CH_SENT_SUB1}]|[{CH_SENT_SUB2_START}]|[{CH_SENT_SUB2_END}])|(?P<wrap_space_comma>.,.)' % (
-                                                        _RETXT_PAR_START1 % "?P<wrap_dash>",
-                                                        _RETXT_PAR_START2 % "?P<wrap_2nl>")))
-_RE_SENT_DO_WRAP =re.compile(_RETXT_SENT_DO_WRAP, flags=re.UNICODE|re.DOTALL|re.MULTILINE)
-# TODO: rest #, $, %, #, *, + , -, =, §, ÷, ×, @, <, >, €, |
-
-# remove following chars - note -!=­(u'\xa')
-_RE_SENT_REPLACE_CHARS_PAIRS = (
-    (re.compile(unicode("([­])+", "utf-8"), re.UNICODE|re.DOTALL|re.MULTILINE), r""),
-    (re.compile(unicode("([…])+", "utf-8"), re.UNICODE|re.DOTALL|re.MULTILINE), r" ... "),
-    )
-
-RE_WORD_ENDS_WITH_JUNK = re.compile(u"^([$\w%s%s%s%s%s%s]{3,})([^$\s\w%s%s%s%s%s%s]{,3})$" % (
-                              _CH_SENT_END,
-                              _CH_SENT_INSEP,
-                              _CH_SENT_INSEP_OTHER, 
-                              _CH_SENT_SUB1,
-                              _CH_SENT_SUB2_START,
-                              _CH_SENT_SUB2_END,
-
-                              _CH_SENT_END,
-                              _CH_SENT_INSEP,
-                              _CH_SENT_INSEP_OTHER, 
-                              _CH_SENT_SUB1,
-                              _CH_SENT_SUB2_START,
-                              _CH_SENT_SUB2_END,
-                              ), re.UNICODE)
-
-_RE_SPLIT_WHITE_SPACE=re.compile('\s', flags=re.UNICODE)
-
-scanner = pyflex.compile(patterns)
+# -------, ********, ======== etc. and \n\n (| is there as in sentence_orig)
+patterns.append(('PAR_START_DASH', r'[\-=*/\\+#]{5,}'))
+patterns.append(('PAR_START_2NL', r'[\n\r|]{2,}'))
+
+# TAG MATCH
+# matches something like this "$tag_name%opts%some-value$"
+# \w for the name: latin-1 letters and digits, above that any char but
+# the general punctuation block
+patterns.append(('TAG_NAME', r'[A-Za-z0-9_]|\xc2[\xaa\xb2\xb3\xb5\xb9\xba\xbc-\xbe]|\xc3[\x80-\x96\x98-\xb6\xb8-\xbf]|[\xc4-\xdf][\x80-\xbf]|\xe2[\x81-\xbf][\x80-\xbf]|[\xe0\xe1\xe3-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}'))
+# \S for the value, but not an ellipsis either, sentence_orig has made that
+# " ... " before it looks for tags
+patterns.append(('TAG_VALUE', r'[^ \t\n\r\f\v\xc2\xe2]|\xc2[^\xa0]|\xe2[^\x80]|\xe2\x80[^\xa6]'))
+
+# chars which become words of their own - sentence inner separators,
+# sub-sentence marks "", (), ... and commas. »«”’ and Ë ť as in sentence_orig
+patterns.append(('CH_SENT_INSEP_OTHER', r'[#:;\-&/]'))
+patterns.append(('CH_SENT_SUB1', r'["`]|\xc2\xbb|\xc2\xab|\xe2\x80\x9d|\xe2\x80\x99|\xc3\x8b|\xc5\xa5'))
+patterns.append(('CH_SENT_SUB2', r'[()\[\]{}]'))
+
+# word chars: anything else, but the chars which may start a longer match
+# ($ a tag, | a paragraph, =*+\ a dash) - these are a word piece of one
+# char, so the longer match wins where sentence_orig finds one
+patterns.append(('WORD_ASCII', r'[^ \t\n\r\f\v,#:;\-&/"`()\[\]{}$|=*+\\\x80-\xff]'))
+patterns.append(('WORD_UTF8', r'\xc2[\x80-\x9f\xa1-\xaa\xac-\xba\xbc-\xbf]|\xc3[\x80-\x8a\x8c-\xbf]|\xc5[\x80-\xa4\xa6-\xbf]|[\xc4\xc6-\xdf][\x80-\xbf]|\xe2\x80[\x80-\x98\x9a-\x9c\x9e-\xa5\xa7-\xbf]|\xe2[\x81-\xbf][\x80-\xbf]|[\xe0\xe1\xe3-\xef][\x80-\xbf]{2}|[\xf0-\xf4][\x80-\xbf]{3}'))
+patterns.append(('WORD_CHAR', r'{WORD_ASCII}|{WORD_UTF8}'))
+patterns.append(('DIGIT', r'[0-9]'))
+
+# emitting rules - on same length the first one wins
+patterns.append(('tag', r'\${TAG_NAME}+%{TAG_VALUE}*%{TAG_VALUE}*\$', True))
+patterns.append(('par_start_dash', r'{PAR_START_DASH}', True))
+patterns.append(('par_start_2nl', r'{PAR_START_2NL}', True))
+patterns.append(('ellipsis', r'(\xe2\x80\xa6)+', True))
+patterns.append(('wrap_space', r'{CH_SENT_INSEP_OTHER}|{CH_SENT_SUB1}|{CH_SENT_SUB2}|,', True))
+# word pieces, glued together into a word. comma stays inside numbers -
+# 9,5 (longer alternative first for the re backend)
+patterns.append(('word', r'{WORD_CHAR}*{DIGIT}(,{DIGIT}({WORD_CHAR}*{DIGIT})?)*,{DIGIT}{WORD_CHAR}*|{WORD_CHAR}+|[$|=*+\\]', True))
+patterns.append(('space', r'{BLANK}|{NL}', True))
+
+scanner = pyflex.compile(patterns, ids=True)
+
+TAG = scanner.kind_ids['tag']
+PAR_START_DASH = scanner.kind_ids['par_start_dash']
+PAR_START_2NL = scanner.kind_ids['par_start_2nl']
+ELLIPSIS = scanner.kind_ids['ellipsis']
+WRAP_SPACE = scanner.kind_ids['wrap_space']
+WORD = scanner.kind_ids['word']
+SPACE = scanner.kind_ids['space']
+
+SOFT_HYPHEN = '\xad'
+
+def preprocess_words(text):
+    """The words of sentence_orig.Tokenizer.preprocess_text(text), split
+    on white space, straight from the scanner. Paragraph starts come as
+    $par_start%dash%-----$ and $par_start%2nl%NLx2$ tags."""
+    if SOFT_HYPHEN in text:
+        # removed before anything else, as in sentence_orig
+        text = text.replace(SOFT_HYPHEN, '')
+    word = None
+    for kind, value in scanner.scan_string(text):
+        if kind == WORD:
+            word = value if word is None else word + value
+            continue
+        if word is not None:
+            yield word
+            word = None
+        if kind == SPACE:
+            continue
+        elif kind == WRAP_SPACE or kind == TAG:
+            yield value
+        elif kind == ELLIPSIS:
+            yield '...'
+        elif kind == PAR_START_DASH:
+            yield '$par_start%%dash%%%s$' % value[:5]
+        elif kind == PAR_START_2NL:
+            yield '$par_start%%2nl%%NLx%d$' % len(value)
+    if word is not None:
+        yield word
+
+def preprocess_text(text):
+    return ' '.join(preprocess_words(text))
+
+def test():
+    text = '''Alat\xadni stro\xadje\xadvi za ski\xadda\xadnje \xadsrha, oš\xadtre\xadnje, bru\xadše\xadnje (honanje), 12,5 i 1,2,3 itd.…
+Kraj: "tu" »to«.
+
+-----
+$tag%opt%value$ zadnji,red=======1,5'''
+    assert list(preprocess_words(text)) == [
+        'Alatni', 'strojevi', 'za', 'skidanje', 'srha', ',',
+        'oštrenje', ',', 'brušenje', '(', 'honanje', ')', ',',
+        '12,5', 'i', '1,2,3', 'itd.', '...',
+        'Kraj', ':', '"', 'tu', '"', '»', 'to', '«', '.',
+        '$par_start%2nl%NLx2$', '$par_start%dash%-----$', '$tag%opt%value$',
+        'zadnji', ',', 'red', '$par_start%dash%=====$', '1,5'], list(preprocess_words(text))
+    # $ is a word char unless it starts a tag, mixed dash runs and soft
+    # hyphens in them, | as a new line - all as in sentence_orig
+    for text, words in [
+            ('Cijena 5$ ili US$10.', ['Cijena', '5$', 'ili', 'US$10.']),
+            ('x$tag%o%v$y', ['x', '$tag%o%v$', 'y']),
+            ('$tag%o%v$\u2026US$', ['$tag%o%v$', '...', 'US$']),
+            ('$tag%o\xa0%v$', ['$tag%o', '%v$']),
+            ('$\xbb%o%v$ $\xe8%o%v$', ['$', '\xbb', '%o%v$', '$\xe8%o%v$']),
+            ('Naslov**//**', ['Naslov', '$par_start%dash%**//*$']),
+            ('ko\xad--\xad---t', ['ko', '$par_start%dash%-----$', 't']),
+            ('a||b x|\ny z|a', ['a', '$par_start%2nl%NLx2$', 'b', 'x', '$par_start%2nl%NLx2$', 'y', 'z|a']),
+            # the comma difference, sentence_orig gives ')', ',x' and 'a', ',', 'b,c'
+            ('),x', [')', ',', 'x']),
+            ('a,b,c', ['a', ',', 'b', ',', 'c'])]:
+        assert list(preprocess_words(text)) == words, (text, list(preprocess_words(text)))
+
+if __name__ == '__main__':
+    test()
@@ -8,6 +8,9 @@ TODO: how to deal with this www.page, or name.com (should be same)
 
 """
 import re
+import codecs
+import collections
+import itertools
 import logging
 #logger = logging.getLogger()
 
@@ -93,6 +96,13 @@ RE_WORD_ENDS_WITH_JUNK = re.compile(u"^([$\w%s%s%s%s%s%s]{3,})([^$\s\w%s%s%s%s%s
 
 _RE_SPLIT_WHITE_SPACE=re.compile('\s', flags=re.UNICODE)
 
+# text is preprocessed in pieces of about this size, cut on white space
+# followed by a word char - preprocess_text does the same around such a 
+# cut, since it can't be inside any _RE_SENT_DO_WRAP match
+PREPROCESS_PIECE_SIZE=8*1024
+_RE_PIECE_CUT = re.compile('\s(?=\w)', flags=re.UNICODE)
+_RE_WORD = re.compile('\S+', flags=re.UNICODE)
+
 # ----------------------------------------
 
 def get_value_repr(value):
@@ -292,6 +302,19 @@ class Abbr(_Base):
 # ----------------------------------------
 
 class Token(object):
+    # no __dict__ per token, there are lots of them
+    __slots__ = ("value", "value_len", "known_abbr", "known_name", 
+                 "is_sent_start", "is_sent_end", "is_number", "is_romnr", 
+                 "is_abbr", "_is_contr", "_is_alpha", "is_name", "is_fuzzy_abbr", 
+                 "is_inner_sep", "is_sent_sub1", "is_sent_sub2_s", "is_sent_sub2_e", 
+                 "is_par_start", "_is_tagged", "tag", "tag_options", "tag_value", 
+                 "is_fuzzy_type", "is_upper")
+    # flags shown by __unicode__, sorted
+    _ATTR_FLAGS = ("is_abbr", "is_contr", "is_fuzzy_abbr", "is_fuzzy_type", 
+                   "is_inner_sep", "is_name", "is_number", "is_romnr", 
+                   "is_sent_end", "is_sent_start", "is_sent_sub1", 
+                   "is_sent_sub2_e", "is_sent_sub2_s", "is_upper")
+
     def __init__(self, value, 
                  is_sent_start=False, 
                  is_sent_end=False, 
@@ -309,21 +332,25 @@ class Token(object):
        
         #self.is_line_start = is_line_start
 
+        # NOTE: most of tokens are just letters - which can't be number, 
+        #       abbr., contraction or tag, and are roman number only when upper, 
+        #       so these checks are skipped for them
+        self._is_alpha = self.value.isalpha()
+        # see is_contr
+        self._is_contr = False if self._is_alpha else None
+
         # TODO: we can distinguish normal and ordinal nr (123.) for reg. and roman numbers
         #       maybe new prop
-        self.is_number = Tokenizer.looks_like_number(self.value, can_end_dot=True)
+        self.is_number = not self._is_alpha and Tokenizer.looks_like_number(self.value, can_end_dot=True)
         # for I. this is roman and abbr. - we count it as abbr.
         self.is_romnr = False
         if not (known_obj and isinstance(known_obj, (Abbr, Name))):
-            self.is_romnr = Tokenizer.looks_like_roman_number(self.value, can_end_dot=True)
-        self.is_abbr = ( not self.is_romnr and not self.is_number and not self.is_sent_end 
-                         and Tokenizer.looks_like_abbr(self.value)
+            self.is_romnr = ((not self._is_alpha or self.value.isupper())
+                             and Tokenizer.looks_like_roman_number(self.value, can_end_dot=True))
+        self.is_abbr = ( not self._is_alpha and not self.is_romnr and not self.is_number 
+                         and not self.is_sent_end and Tokenizer.looks_like_abbr(self.value)
                        )
 
-        # is it contraction e.g. isn't, oš'
-        self.is_contr = Tokenizer.looks_like_contraction(self.value)
-
-        self._is_alpha = self.value.isalpha()
         assert not (self.is_abbr and not self.value[:-1].isalpha()), self.value
         if known_obj:
             assert isinstance(known_obj, (Abbr, Name))
@@ -340,16 +367,18 @@ class Token(object):
                             and self.value.istitle()
                             and len(self.value)>1)
         self.is_fuzzy_abbr = ( not self.is_romnr and not self.is_number 
-                               and not self.is_contr
-                               and self.value.find(".") not in (-1, 0, self.value_len-1) )
+                               and self.value.find(".") not in (-1, 0, self.value_len-1) 
+                               and not self.is_contr)
         self.is_inner_sep   = self.value in _CH_SENT_INSEP
         self.is_sent_sub1   = self.value in _CH_SENT_SUB1
         self.is_sent_sub2_s = self.value in _CH_SENT_SUB2_START
         self.is_sent_sub2_e = self.value in _CH_SENT_SUB2_END
         self.is_par_start=False 
-        m = _RE_TAG.match(self.value)
+        m = _RE_TAG.match(self.value) if self.value.startswith("$") else None
         # NOTE: only one tag supported
         if m:
+            # tag is not contraction, and the value it gets can be
+            self._is_contr = False
             self._is_tagged = True
             self.tag         = m.groupdict()["tag"]
             self.tag_options = m.groupdict()["tag_options"]
@@ -373,8 +402,8 @@ class Token(object):
                                   and not self.is_sent_end 
                                   and not self.is_number 
                                   and not self.is_romnr 
-                                  and not self.is_contr
-                                  and not self._is_alpha)
+                                  and not self._is_alpha
+                                  and not self.is_contr)
         if known_obj and isinstance(known_obj, Abbr):
             if not self.is_abbr:
                 assert self.is_abbr
@@ -408,6 +437,13 @@ class Token(object):
         if do_lower:
             self.value = self.value.lower()
 
+    @property
+    def is_contr(self):
+        " is it contraction e.g. isn't, oš' - regexp is done only when asked "
+        if self._is_contr is None:
+            self._is_contr = Tokenizer.looks_like_contraction(self.value)
+        return self._is_contr
+
     def __unicode__(self):
         """
         Matches something like this "$par_start%%test$"
@@ -452,7 +488,7 @@ class Token(object):
         >>> print Token(" 123   ")
         T('123'/number)
         """
-        attrs = ["%s" % an[3:] for an, av in sorted(self.__dict__.iteritems()) if an.startswith("is_") and an not in ("is_par_start",) and av==True]
+        attrs = ["%s" % an[3:] for an in self._ATTR_FLAGS if getattr(self, an)==True]
         if self._is_tagged :
             attrs.append("%s%s" % (self.tag, ("=%s" % self.tag_options) if self.tag_options else ""))
         if self.known_abbr and not self.known_abbr.is_new:
@@ -521,6 +557,109 @@ class TokenizerParams(object):
         return "%s at %0X" % (str(self), id(self))
 
 # ----------------------------------------
+
+class WordCursor(object):
+    """ words left to tokenize, words[0] is the current one. Words are kept 
+    in reversed order, so moving to next word and replacing some word 
+    with several (split_word, join_punc_chars) costs as much as 
+    the distance from the current word and not the length of the text.
+    Supports what tokenize needs from list: len, index and slice get/set.
+    Words which are not given as list are read lazily, only as far as they
+    are looked at, so just a few of them are held whatever the text size is.
+    They are read READ_BLOCK at a time, and len() counts the words read so
+    far, reading at least LOOKAHEAD of them - it is exact only when fewer 
+    are left, which is all tokenize needs to know.
+
+    >>> words = WordCursor(["prof.dr.J.Malkovich", "is", "here", "."])
+    >>> words[0:1] = ["prof.", "dr.", "J.", "Malkovich"]
+    >>> words[0], words[3:5], len(words)
+    ('prof.', ['Malkovich', 'is'], 7)
+    >>> words.advance(3)
+    >>> words[1] = "was"
+    >>> words[:], words[-1]
+    (['Malkovich', 'was', 'here', '.'], '.')
+    >>> words.advance(4)
+    >>> len(words), words[0:5]
+    (0, [])
+
+    >>> import itertools
+    >>> words = WordCursor(itertools.count())
+    >>> words.READ_BLOCK = 2
+    >>> words[5], len(words)
+    (5, 6)
+    >>> words.advance(5)
+    >>> len(words), words[0:2]
+    (3, [5, 6])
+    """
+    LOOKAHEAD = 3
+    READ_BLOCK = 64
+
+    def __init__(self, word_list):
+        if isinstance(word_list, list):
+            self._reversed = word_list[::-1]
+            self._words = None
+        else:
+            self._reversed = []
+            self._words = iter(word_list)
+
+    def _read(self, count=None):
+        " reads words until at least count of them are held, all if count is None "
+        if self._words is None:
+            return
+        if count is None:
+            words = list(self._words)
+            self._words = None
+        else:
+            wanted = max(count-len(self._reversed), self.READ_BLOCK)
+            words = list(itertools.islice(self._words, wanted))
+            if len(words)<wanted:
+                self._words = None
+        words.reverse()
+        self._reversed[0:0] = words
+
+    def __len__(self):
+        if len(self._reversed)<self.LOOKAHEAD:
+            self._read(self.LOOKAHEAD)
+        return len(self._reversed)
+
+    def _reversed_slice(self, key):
+        if (key.start or 0)<0 or key.stop is None or key.stop<0:
+            self._read()
+        elif key.stop>len(self._reversed):
+            self._read(key.stop)
+        start, stop, step = key.indices(len(self._reversed))
+        assert step==1, key
+        stop = max(start, stop)
+        return slice(len(self._reversed)-stop, len(self._reversed)-start)
+
+    def _reversed_index(self, key):
+        if key<0:
+            self._read()
+            key += len(self._reversed)
+        elif key>=len(self._reversed):
+            self._read(key+1)
+        if not 0<=key<len(self._reversed):
+            raise IndexError("word index out of range")
+        return len(self._reversed)-1-key
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._reversed[self._reversed_slice(key)][::-1]
+        return self._reversed[self._reversed_index(key)]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            self._reversed[self._reversed_slice(key)] = list(value)[::-1]
+        else:
+            self._reversed[self._reversed_index(key)] = value
+
+    def advance(self, count=1):
+        " drop current word and count-1 words after it "
+        if count>len(self._reversed):
+            self._read(count)
+        del self._reversed[max(0, len(self._reversed)-count):]
+
+# ----------------------------------------
         
 class Tokenizer(object):
     """ nltk.PunktTokenizer() or pickled one was not good enough so i 
@@ -792,10 +931,12 @@ class Tokenizer(object):
         punc_word_new = [punc_word]
         while True:
             ind_new += 1 
-            if ind_new>len(word_list)-1:
+            # not len() - WordCursor reads words as they are indexed
+            try:
+                tmp_word = word_list[ind_new].strip()
+            except IndexError:
                 ind_new -= 1 
                 break
-            tmp_word = word_list[ind_new].strip()
             m_starts = _RE_STARTS_SENT_END.match(tmp_word)
             if _RE_ONLY_SENT_END.match(tmp_word):
                 punc_word_new.append(tmp_word)
@@ -881,98 +1022,101 @@ class Tokenizer(object):
         ['This', 'is', 'not', 'UPPER', 'CASE!', 
          'this', 'is', 'not', 'UPPER', 'CASE.', 'This', 'is', 'NOT.']
         """
+        return list(cls.iter_preprocess_word_list(word_list))
+
+    @classmethod
+    def iter_preprocess_word_list(cls, words):
+        """ preprocess_word_list for any iterable of words, as a generator.
+        Looks at most 2 words ahead, empty words are skipped.
+
+        >>> list(Tokenizer.iter_preprocess_word_list(iter(["THIS", "", "IS", "UPPER", "CASE"])))
+        ['This', 'is', 'upper', 'case']
+        """
         # older logic ;)
         #word_list = [w.strip() for w in word_list if w]
 
-        word_list_new = []
-
-        word_list_last_ind = len(word_list)-1
+        words = iter(words)
+        # next non empty words, preprocessing can remove them
+        upcoming = collections.deque()
 
         current_wl = []
         current_cnt_upper = 0
 
-        ind = -1
-
         def is_word_upper(word):
             """ returns 1 if yes else 0. Currently used only once"""
             if word.isupper() or not word.isalpha():
                 return 1
             return 0
 
+        def fill_upcoming(count):
+            while len(upcoming)<count:
+                for word in words:
+                    if word:
+                        upcoming.append(word)
+                        break
+                else:
+                    return
+
         while True:
-            ind+=1
-            if ind>word_list_last_ind:
+            fill_upcoming(3)
+            if not upcoming:
                 assert not current_wl, current_wl
                 break
-            is_new_sentence = (ind==word_list_last_ind)
-            word = word_list[ind]
-
-            def get_next_word(word_list, ind):
-                if ind is None:
-                    return None
-                i = ind+1
-                while i<=word_list_last_ind:
-                    #if not (i-ind)<250:
-                    #    import pdb;pdb.set_trace() 
-                    assert i-ind<250, "preprocessing problem - there is more than 250 empty words between %s and %s (locations %d-%d)" % (
-                        word_list[ind-15:ind+1], word_list[i:i+15], ind, i)
-                    if word_list[i]:
-                        return i
-                    i+=1
-                return None
-                
-            if word:
-                ind_next = get_next_word(word_list, ind)
-                ind_next2 = get_next_word(word_list, ind_next)
-
-                #       w wn wn2
-                # 'this : "  Title' -> 'this ! Title'
-                # 'this : 'Title' -> 'this ! Title'
-                # 'this - "Title' -> 'this ! Title'
-                # , '"', "'"
-                if (ind_next is not None 
-                    and ind_next2 is not None 
-                    and word in (':', '-', ',', ';')
-                    and word_list[ind_next] in ('"', "'")
-                    and word_list[ind_next2].istitle()):
-                    word = "!"
-                    word_list[ind_next] = ""
-                #       w wn    wn2
-                # 'this " Title ... ' -> 'this ! Title'
-                # 'this : Title ... ' -> 'this ! Title'
-                elif (ind_next is not None 
-                    and word in ('"', "'", ":")
-                    and word_list[ind_next].istitle()):
-                    word = "!"
-
-                #     w wn wn2
-                # 'this. - Title ... ' -> 'this. Title'
-                elif (ind_next is not None 
-                    and ind_next2 is not None 
-                    and word.endswith(".")
-                    and word_list[ind_next] in ('-', "!", '"', "'", "*")
-                    and word_list[ind_next2].istitle()):
-                    word_list[ind_next] = ""
-                
-                current_wl.append(word.strip())
-
-                current_cnt_upper += is_word_upper(word)
-
-                tag, tag_options, tag_value = cls.get_word_tag(word)
-
-                
-                # Not exact but good enough
-                # at least 4 words are considered sentence - 
-                # to avoid abbr. terminate sentence
-                if not is_new_sentence:
-                    is_new_sentence = len(current_wl)>=3 and (
-                                         (tag=="par_start" or 
-                                          word[-1] in (_CH_SENT_END)))
-
-                if is_new_sentence and ind_next is not None:
-                    # 'end." Title' -> 'end. Title'
-                    if word_list[ind_next] in ('"', "'"):
-                        word_list[ind_next] = ''
+            word = upcoming.popleft()
+            word_next  = upcoming[0] if len(upcoming)>0 else None
+            word_next2 = upcoming[1] if len(upcoming)>1 else None
+            is_new_sentence = (word_next is None)
+
+            #       w wn wn2
+            # 'this : "  Title' -> 'this ! Title'
+            # 'this : 'Title' -> 'this ! Title'
+            # 'this - "Title' -> 'this ! Title'
+            # , '"', "'"
+            if (word_next is not None 
+                and word_next2 is not None 
+                and word in (':', '-', ',', ';')
+                and word_next in ('"', "'")
+                and word_next2.istitle()):
+                word = "!"
+                upcoming.popleft()
+                word_next = ""
+            #       w wn    wn2
+            # 'this " Title ... ' -> 'this ! Title'
+            # 'this : Title ... ' -> 'this ! Title'
+            elif (word_next is not None 
+                and word in ('"', "'", ":")
+                and word_next.istitle()):
+                word = "!"
+
+            #     w wn wn2
+            # 'this. - Title ... ' -> 'this. Title'
+            elif (word_next is not None 
+                and word_next2 is not None 
+                and word.endswith(".")
+                and word_next in ('-', "!", '"', "'", "*")
+                and word_next2.istitle()):
+                upcoming.popleft()
+                word_next = ""
+            
+            current_wl.append(word.strip())
+
+            current_cnt_upper += is_word_upper(word)
+
+            tag, tag_options, tag_value = cls.get_word_tag(word)
+
+            
+            # Not exact but good enough
+            # at least 4 words are considered sentence - 
+            # to avoid abbr. terminate sentence
+            if not is_new_sentence:
+                is_new_sentence = len(current_wl)>=3 and (
+                                     (tag=="par_start" or 
+                                      word[-1] in (_CH_SENT_END)))
+
+            if is_new_sentence and word_next is not None:
+                # 'end." Title' -> 'end. Title'
+                if word_next in ('"', "'"):
+                    upcoming.popleft()
 
             if is_new_sentence and current_wl:
                 def is_upper(cnt_upper, list_len):
@@ -994,13 +1138,12 @@ class Tokenizer(object):
                                 w = w.title()
                             else:
                                 w = w.lower()
-                        word_list_new.append(w)
+                        yield w
                 else:
-                    word_list_new.extend(current_wl)
+                    for w in current_wl:
+                        yield w
                 current_wl = []
                 current_cnt_upper = 0
-                 
-        return word_list_new
 
     @classmethod
     def get_next_is_punct_title(cls, start_ind, word_list_next):
@@ -1098,6 +1241,76 @@ class Tokenizer(object):
         text_new = _RE_SENT_DO_WRAP.sub(fun_repl_wrap_spaces, text_new)
         return text_new
 
+    @classmethod
+    def iter_words(cls, text):
+        """ preprocess_word_list(split_text(preprocess_text(text))) in one go,
+        as a generator. Text is preprocessed piece by piece (pieces end before
+        a word char, see _RE_PIECE_CUT), white space is skipped while 
+        splitting, so neither preprocessed text nor word list with empty 
+        words is ever built for the whole text.
+
+        >>> text = u'THIS IS UPPER CASE. This he said : " Today is the day. "'
+        >>> list(Tokenizer.iter_words(text))==Tokenizer.preprocess_word_list(Tokenizer.split_text(Tokenizer.preprocess_text(text)))
+        True
+        """
+        return cls.iter_preprocess_word_list(cls._iter_text_words(text))
+
+    @classmethod
+    def _iter_text_words(cls, text, piece_size=None):
+        """
+        >>> list(Tokenizer._iter_text_words(u"Is this (the) end,my friend?\\n\\nYes", piece_size=3))
+        [u'Is', u'this', u'(', u'the', u')', u'end', u',', u'my', u'friend?', u'$par_start%2nl%NLx2$', u'Yes']
+        """
+        if not piece_size:
+            piece_size = PREPROCESS_PIECE_SIZE
+        start = 0
+        while start<len(text):
+            m = _RE_PIECE_CUT.search(text, start+piece_size)
+            end = m.end() if m else len(text)
+            for m in _RE_WORD.finditer(cls.preprocess_text(text[start:end])):
+                yield m.group()
+            start = end
+
+    @classmethod
+    def _iter_stream_words(cls, chunks, cp="utf-8", piece_size=None):
+        """ _iter_text_words for text which comes in chunks. Non-unicode 
+        chunks are decoded incrementally, so multibyte chars can be split
+        between chunks. Each chunk is searched for cuts once, and pending 
+        text is joined only to cut a piece of at least piece_size chars 
+        from it, so the time stays linear however long a text goes 
+        without a cut.
+
+        >>> list(Tokenizer._iter_stream_words(["Is th", "is (the) e", "nd,my frie", "nd?\\n", "\\nYes"], piece_size=3))
+        [u'Is', u'this', u'(', u'the', u')', u'end', u',', u'my', u'friend?', u'$par_start%2nl%NLx2$', u'Yes']
+        >>> list(Tokenizer._iter_stream_words(["\\xc5", "\\xa1 \\xc5\\xa1"], piece_size=1))
+        [u'\\u0161', u'\\u0161']
+        """
+        if not piece_size:
+            piece_size = PREPROCESS_PIECE_SIZE
+        decoder = codecs.getincrementaldecoder(cp)("replace")
+        # text not preprocessed yet, and the last cut found in it
+        pending, pending_len, cut = [], 0, None
+        for chunk in chunks:
+            if not isinstance(chunk, unicode):
+                chunk = decoder.decode(chunk)
+            if not chunk:
+                continue
+            # a cut can start at the last char of the previous chunk
+            tail = pending[-1][-1:] if pending else u""
+            for m in _RE_PIECE_CUT.finditer(tail + chunk):
+                cut = pending_len - len(tail) + m.end()
+            pending.append(chunk)
+            pending_len += len(chunk)
+            if cut is None or cut<piece_size:
+                continue
+            text = u"".join(pending)
+            for m in _RE_WORD.finditer(cls.preprocess_text(text[:cut])):
+                yield m.group()
+            pending, pending_len, cut = [text[cut:]], pending_len-cut, None
+        pending.append(decoder.decode("", True))
+        for m in _RE_WORD.finditer(cls.preprocess_text(u"".join(pending))):
+            yield m.group()
+
     def tokenize(self, text_or_paramsobject, cp="utf-8", in_abbr_list=None, in_name_list=None):
         " splits and marks if sentence end, abbr, name"
         if isinstance(text_or_paramsobject, basestring):
@@ -1121,11 +1334,18 @@ class Tokenizer(object):
             
         # ------------- REGEXP REPLACE PREPROCESS -----------------
         # NOTE: insert space before and/or after some interpunction chars
-        params.text = self.preprocess_text(params.text)
-
         # ------------- SPLIT BY WHITESPACE -----------------------
-        #word_list = list(_RE_SPLIT_WHITE_SPACE.split(params.text))
-        params.word_list = self.split_text(params.text)
+        # --------------- FIRST PASS - preprocess ---------------
+        # all three done by iter_words in one pass
+        params.word_list = self.iter_words(params.text)
+        for token in self.tokenize_words(params):
+            yield token
+
+    def tokenize_words(self, params):
+        """ the second pass of tokenize, for params.word_list which can be 
+        any iterable of preprocessed words (see iter_words) - it is read
+        only a few words ahead of the current one. params.abbr_list and 
+        params.name_list must be set up already. """
 
         def _add_token(current, name_list, word_or_name_or_abbr, is_sent_end=False):
             known_obj = None
@@ -1146,14 +1366,11 @@ class Tokenizer(object):
                                  is_sent_end=is_sent_end, 
                                  known_obj=known_obj))
 
-        # --------------- FIRST PASS - preprocess ---------------
-
-        # OLD_LOGIC: params.word_list = [w.strip() for w in params.word_list if w]
-        params.word_list = self.preprocess_word_list(params.word_list)
-
         # --------------- SECOND PASS - tokenize and yield ---------------
+        # NOTE: indexes are relative to current word (0), word list shrinks
+        #       as words are consumed - see WordCursor
+        params.word_list = WordCursor(params.word_list)
         current = []
-        ind = -1 # this is important
         # TODO: second pass will better dinstinguish between abbr. and sent. end and Name and sent start
 
         def postprocess_sentence(current, mark_last=False):
@@ -1171,9 +1388,9 @@ class Tokenizer(object):
             return current_new
 
         while True:
-            ind+=1
-            #assert ind<=len(params.word_list)
-            if ind==len(params.word_list):
+            # last word consumed by this step, join_punc_chars can move it
+            ind = 0
+            if not params.word_list:
                 # send last sentence
                 for i, token in enumerate(postprocess_sentence(current, mark_last=True)):
                     yield token
@@ -1185,10 +1402,10 @@ class Tokenizer(object):
             word_inner_list = self.split_word(word_outer, params.abbr_list) 
             if word_inner_list:
                 # NOTE: content changed - stay on first new and go on
-                params.word_list[ind:ind+1] = word_inner_list
-            word = params.word_list[ind].strip()
+                params.word_list[0:1] = word_inner_list
+            word = params.word_list[0].strip()
             assert word, word_outer
-            is_last_word = (ind+1==len(params.word_list))
+            is_last_word = (len(params.word_list)==1)
             word = word.strip()
             assert word
             is_new_sentence = False
@@ -1197,9 +1414,9 @@ class Tokenizer(object):
             word_next = NOVALUE_WORD
             word_next2 = NOVALUE_WORD
             if not is_last_word:
-                word_next = params.word_list[ind+1].strip()
-                if not (ind+2==len(params.word_list)):
-                    word_next2 = params.word_list[ind+2].strip()
+                word_next = params.word_list[1].strip()
+                if not (len(params.word_list)==2):
+                    word_next2 = params.word_list[2].strip()
 
             tag, tag_options, tag_value = self.get_word_tag(word)
             if tag:
@@ -1225,8 +1442,8 @@ class Tokenizer(object):
                     # abbr. or sentence end
                     is_abbr = False
                     is_number_or_romnr = False
-                    word_list_next = params.word_list[ind+1:ind+6]
-                    next_is_punct_title, set_lower_title_ind = self.get_next_is_punct_title(ind+1, 
+                    word_list_next = params.word_list[1:6]
+                    next_is_punct_title, set_lower_title_ind = self.get_next_is_punct_title(1, 
                                                                                    word_list_next)
                     #if word.startswith("2008."):
                     #    import pdb;pdb.set_trace() 
@@ -1252,7 +1469,7 @@ class Tokenizer(object):
                                 is_number_or_romnr = True
                                 _add_token(current, params.name_list, word)
                                 if not word_next.endswith(".") and word_next.istitle():
-                                    params.word_list[ind+1] = word_next.lower() # won't be recognized as name
+                                    params.word_list[1] = word_next.lower() # won't be recognized as name
                             # next two have the same logic
                             # Mr. Magoo is nice guy. 
                             elif params.fun_abbr_name(word, known_abbr, params, word_list_next):
@@ -1328,9 +1545,46 @@ class Tokenizer(object):
                 for i, token in enumerate(postprocess_sentence(current)):
                     yield token
                 current = []
+            params.word_list.advance(ind+1)
 
         return 
 
+    def tokenize_stream(self, chunks, cp="utf-8", in_abbr_list=None, in_name_list=None, piece_size=None):
+        """ like tokenize, but for text which comes in chunks (file, lines,
+        socket ...). Text is preprocessed piece by piece as it comes in
+        (see _iter_stream_words) and tokenized reading only a few words 
+        ahead (see WordCursor), so memory stays bounded by piece_size and 
+        the chunk size whatever the text size is. Tokens are the ones 
+        tokenize gives for the whole text.
+
+        >>> t = Tokenizer()
+        >>> text = "Prvi odlomak ima recenicu. I jos jednu!\\n\\nDrugi odlomak je ovdje."
+        >>> chunks = [text[i:i+7] for i in range(0, len(text), 7)]
+        >>> map(repr, t.tokenize_stream(chunks, piece_size=16))==map(repr, t.tokenize(text))
+        True
+
+        Abbreviations, numbers and names decided by looking at the next 
+        words come out the same wherever the pieces are cut:
+        >>> text = "Pisao je J. Malkovich. Ovo je 12. Sijecnja bilo. Kraj."
+        >>> chunks = [text[i:i+3] for i in range(0, len(text), 3)]
+        >>> map(repr, t.tokenize_stream(chunks, piece_size=1))==map(repr, t.tokenize(text))
+        True
+        >>> list(t.tokenize_stream(chunks, piece_size=1))[2:4]
+        [T('J.'/abbr), T('Malkovich'/name)]
+
+        Works for never ending input too:
+        >>> import itertools
+        >>> list(itertools.islice(t.tokenize_stream(itertools.cycle(["Ovo je recenica. "]), piece_size=64), 5))
+        [T('ovo'/sent_start), T('je'), T('recenica'), T('.'/sent_end), T('ovo'/sent_start)]
+        """
+        params = TokenizerParams()
+        params.abbr_list = self._check_item_list(Abbr, in_abbr_list)
+        params.name_list = self._check_item_list(Name, in_name_list)
+        params.word_list = self.iter_preprocess_word_list(
+                self._iter_stream_words(chunks, cp, piece_size))
+        for token in self.tokenize_words(params):
+            yield token
+
 # TODO: move this function somewhere!!!
 # TODO: is this needed, not in this way, see _RE_ROMNR and unit test - that is much easier
 #def roman2nr(s, raise_on_err=True):
@@ -1428,6 +1682,12 @@ def tokenize(text_or_paramsobject, cp="utf-8", in_abbr_list=None, in_name_list=N
                                 in_name_list=in_name_list)
     return result
 
+def tokenize_stream(chunks, cp="utf-8", in_abbr_list=None, in_name_list=None, piece_size=None):
+    tokenizer = Tokenizer()
+    return tokenizer.tokenize_stream(chunks, cp=cp, in_abbr_list=in_abbr_list,
+                                     in_name_list=in_name_list,
+                                     piece_size=piece_size)
+
 def main():
     # TODO: tokenize input text)
     pass
@@ -1,19 +1,29 @@
 import pyflex
 
-tokenizer = pyflex.compile([
-    ('token', '[^\s]+', True),
+patterns = [
+    ('token', r'[^ \t\r\n]+', True),
     ('line_end', r'[\r\n]+', True)
-])
+]
+
+tokenizer = pyflex.compile(patterns, ids=True)
+
+TOKEN = tokenizer.kind_ids['token']
+LINE_END = tokenizer.kind_ids['line_end']
 
 def tokenize(ins):
     line = []
     for kind, val in tokenizer.scan_string(ins):
-        if kind == 'token':
+        if kind == TOKEN:
             line.append(val)
-        elif kind == 'line_end':
+        elif kind == LINE_END:
             yield line
             line = []
 
+def count(ins):
+    "(tokens, line ends) in ins, counted without building any tokens"
+    counts = tokenizer.count(ins)
+    return counts[TOKEN], counts[LINE_END]
+
 def test():
     text = '''This is a line.
     And this is another.'''